@@ -13,9 +13,26 @@
 # limitations under the License.
 
 
-from .cart import cart_page
-from .charge import charge_page
-from .checkout import checkout_page
-from .product_catalog import product_catalog_page
-from .sell import sell_page
-from .signin import signin_page
+# Blueprints are imported on first access, so that importing one blueprint
+# (e.g. blueprints.cart) does not import all the others.
+
+
+import importlib
+
+_BLUEPRINT_MODULES = {
+    'cart_page': '.cart',
+    'charge_page': '.charge',
+    'checkout_page': '.checkout',
+    'product_catalog_page': '.product_catalog',
+    'sell_page': '.sell',
+    'signin_page': '.signin'
+}
+
+__all__ = list(_BLUEPRINT_MODULES)
+
+
+def __getattr__(name):
+    if name in _BLUEPRINT_MODULES:
+        module = importlib.import_module(_BLUEPRINT_MODULES[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f'module {__name__} has no attribute {name}')
@@ -41,14 +41,17 @@ def display(auth_context):
     """
 
     cart = carts.get_cart(auth_context.get('uid'))
-    for item in cart:
-        product = product_catalog.get_product(item.item_id)
+    # Items in per-user carts already carry a snapshot of their products.
+    missing = [item for item in cart if not item.info]
+    products = product_catalog.get_products([item.item_id for item in missing])
+    for item, product in zip(missing, products):
         item.info = product
+    # Skip items whose product listing no longer exists.
+    cart = [item for item in cart if item.info]
 
     return render_template("cart.html",
                            cart=cart,
-                           auth_context=auth_context,
-                           bucket=product_catalog.BUCKET)
+                           auth_context=auth_context)
 
 
 @cart_page.route('/cart', methods=['POST'])
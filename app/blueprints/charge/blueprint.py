@@ -21,17 +21,13 @@ This module is the Flask blueprint for the charge page (/charge).
 import os
 
 from flask import Blueprint, render_template
-from opencensus.trace.tracer import Tracer
-from opencensus.trace.exporters import stackdriver_exporter
 
-from helpers import eventing, orders, product_catalog
+from helpers import eventing, instrumentation, orders, product_catalog
 from middlewares.auth import auth_optional
 from middlewares.form_validation import checkout_form_validation_required
 
 PUBSUB_TOPIC_PAYMENT_PROCESS = os.environ.get('PUBSUB_TOPIC_PAYMENT_PROCESS')
 
-sde = stackdriver_exporter.StackdriverExporter()
-
 charge_page = Blueprint('charge_page', __name__)
 
 
@@ -52,13 +48,12 @@ def process(auth_context, form):
        Rendered HTML page.
     """
 
-    # Create an OpenCensus tracer to trace each payment process, and export
-    # the data to Stackdriver Tracing.
-    tracer = Tracer(exporter=sde)
-    trace_id = tracer.span_context.trace_id
+    # Trace the payment process as part of the trace of the request, if
+    # tracing is enabled. See middlewares/tracing.py for more information.
+    trace_id = instrumentation.trace_id()
 
     # Prepare the order
-    with tracer.span(name="prepare_order_info"):
+    with instrumentation.span("prepare_order_info"):
         product_ids = form.product_ids.data
         stripe_token = form.stripeToken.data
         shipping = orders.Shipping(address_1=form.address_1.data,
@@ -68,15 +63,22 @@ def process(auth_context, form):
                                    zip_code=form.zip_code.data,
                                    email=form.email.data,
                                    mobile=form.mobile.data)
-        amount = product_catalog.calculate_total_price(product_ids)
+        try:
+            amount = product_catalog.calculate_total_price(product_ids)
+        except product_catalog.ProductNotFoundError:
+            return 'Some of the items are no longer available.', 400
+        # Items checked out from the cart of the user are removed from it
+        # by Cloud Function pay_with_stripe once the payment succeeds.
+        cart_uid = auth_context.get('uid') if auth_context and form.from_cart.data else None
         order = orders.Order(amount=amount,
                              shipping=shipping,
-                             status="order_created",
-                             items=product_ids)
+                             status=orders.ORDER_CREATED,
+                             items=product_ids,
+                             cart_uid=cart_uid)
         order_id = orders.add_order(order)
 
     # Stream a Payment event
-    with tracer.span(name="send_payment_event"):
+    with instrumentation.span("send_payment_event"):
         if stripe_token:
             # Publish an event to the topic for new payments.
             # Cloud Function pay_with_stripe subscribes to the topic and
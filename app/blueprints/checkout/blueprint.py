@@ -55,15 +55,19 @@ def display(auth_context):
     elif from_cart:
         uid = auth_context.get('uid')
         cart = carts.get_cart(uid)
-        for item in cart:
-            product = product_catalog.get_product(item.item_id)
-            products.append(product)
+        missing = [item for item in cart if not item.info]
+        products = product_catalog.get_products([item.item_id for item in missing])
+        for item, product in zip(missing, products):
+            item.info = product
+        products = [item.info for item in cart]
+    # Skip products whose listing no longer exists.
+    products = [product for product in products if product]
 
     if products:
         return render_template('checkout.html',
                                products=products,
                                auth_context=auth_context,
                                form=form,
-                               bucket=product_catalog.BUCKET)
+                               from_cart=not product_id and bool(from_cart))
 
     return redirect(url_for('product_catalog_page.display'))
@@ -18,11 +18,17 @@ This module is the Flask blueprint for the product catalog page (/).
 """
 
 
-from flask import Blueprint, render_template
+import os
 
-from helpers import product_catalog
+from flask import Blueprint, render_template, request
+
+from helpers import concurrency, product_catalog
 from middlewares.auth import auth_optional
 
+CATALOG_PAGE_SIZE = int(os.environ.get('CATALOG_PAGE_SIZE', 30))
+# Time budget for loading promotions, in seconds.
+PROMOS_TIMEOUT = float(os.environ.get('PROMOS_TIMEOUT', 0.5))
+
 product_catalog_page = Blueprint('product_catalog_page', __name__)
 
 
@@ -39,11 +45,36 @@ def display(auth_context):
        Rendered HTML page.
     """
 
-    products = product_catalog.list_products()
-    # Get promoted products recommended by the AutoML model.
-    promos = product_catalog.get_promos()
+    cursor = request.args.get('cursor')
+    # Load the products and the promotions concurrently.
+    # Promotions are only displayed on the first page.
+    products_future = concurrency.submit('list_products',
+                                         product_catalog.list_products,
+                                         page_size=CATALOG_PAGE_SIZE,
+                                         cursor=cursor)
+    promos_future = None
+    if not cursor:
+        # Get promoted products recommended by the AutoML model.
+        promos_future = concurrency.submit('get_promos',
+                                           product_catalog.get_promos)
+
+    try:
+        products = products_future.result()
+    except ValueError:
+        return 'Something does not look right. Check your input and try again.', 400
+
+    next_cursor = None
+    if len(products) == CATALOG_PAGE_SIZE:
+        next_cursor = product_catalog.encode_cursor(products[-1])
+
+    promos = []
+    if promos_future:
+        # A slow or failing promotion query should not hold up the catalog.
+        promos = concurrency.result_or_default(promos_future,
+                                               timeout=PROMOS_TIMEOUT,
+                                               default=[])
     return render_template('product_catalog.html',
                            products=products,
+                           next_cursor=next_cursor,
                            promos=promos,
-                           auth_context=auth_context,
-                           bucket=product_catalog.BUCKET)
+                           auth_context=auth_context)
@@ -0,0 +1,157 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+An in-process, thread-safe LRU cache with per-entry expiration.
+"""
+
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    """
+    A bounded LRU cache. Entries expire after a time-to-live (TTL); the
+    least recently used entry is evicted when the cache is full.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        """
+        Parameters:
+           max_size (int): The maximum number of entries to keep.
+           ttl (float): The default time-to-live of entries, in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Gets a value from the cache.
+
+        Parameters:
+           key: The key of the entry.
+           default: The value to return if the entry is missing or expired.
+
+        Output:
+           The cached value, or default.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        Adds a value to the cache, evicting the least recently used entry if
+        the cache is full.
+
+        Parameters:
+           key: The key of the entry.
+           value: The value to cache.
+           ttl (float): The time-to-live of the entry, in seconds. Defaults
+                        to the TTL of the cache.
+
+        Output:
+           None.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Removes an entry from the cache, if present.
+
+        Parameters:
+           key: The key of the entry.
+
+        Output:
+           None.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+
+        Parameters:
+           None.
+
+        Output:
+           None.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def keys(self):
+        """
+        Lists the keys of the entries that have not expired.
+
+        Parameters:
+           None.
+
+        Output:
+           A list of keys, from least to most recently used.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [key for key, entry in self._entries.items() if entry[1] > now]
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """
+        Reports the usage of the cache.
+
+        Parameters:
+           None.
+
+        Output:
+           A dict with the number of hits, misses and entries.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries)
+            }
@@ -14,4 +14,5 @@
 
 
 from .helpers import *
+from .cart_removal import *
 from .data_classes import CartItem
@@ -0,0 +1,77 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Removal of checked-out items from carts, in either cart storage mode (see
+helpers.py).
+
+Cloud Function pay_with_stripe removes the items of an order from its cart
+once the order is paid, and holds a copy of this module; test
+test_shared_module_copies in app/main_test.py checks that it matches.
+"""
+
+
+from google.cloud import firestore
+
+# A batched write holds at most 500 operations.
+MAX_BATCH_SIZE = 500
+
+
+def remove_items(client, uid, item_ids, per_user):
+    """
+    Helper function for deleting multiple items from a cart, e.g. after
+    checking them out.
+
+    Parameters:
+       client (Client): The Firestore client.
+       uid (str): The unique ID of an user.
+       item_ids (List[str]): The IDs of the items.
+       per_user (bool): Whether carts are stored per user.
+
+    Output:
+       The numbers of documents read and written, as a tuple. Raises the
+       errors of Firestore; items may then be left in the cart.
+    """
+
+    item_ids = set(item_ids)
+    if not item_ids:
+        return 0, 0
+
+    if per_user:
+        reference = client.collection('user_carts').document(uid)
+
+        @firestore.transactional
+        def transactional_remove_items(transaction):
+            document = reference.get(transaction=transaction)
+            if not document.exists:
+                return 0
+            items = document.to_dict().get('items', [])
+            kept = [item for item in items if item.get('item_id') not in item_ids]
+            if len(kept) == len(items):
+                return 0
+            transaction.update(reference, {'items': kept})
+            return 1
+
+        return 1, transactional_remove_items(client.transaction())
+
+    documents = list(client.collection('carts').where('uid', '==', uid).get())
+    references = [document.reference for document in documents
+                  if document.get('item_id') in item_ids]
+    for start in range(0, len(references), MAX_BATCH_SIZE):
+        batch = client.batch()
+        for reference in references[start:start + MAX_BATCH_SIZE]:
+            batch.delete(reference)
+        batch.commit()
+    return len(documents), len(references)
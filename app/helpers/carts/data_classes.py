@@ -20,6 +20,9 @@ Data class for cart items.
 
 from dataclasses import dataclass
 
+from helpers.product_catalog import Product
+
+
 @dataclass
 class CartItem:
     """
@@ -29,6 +32,7 @@ class CartItem:
     modify_time: str
     uid: str
     document_id: str = None
+    info: Product = None
 
     @staticmethod
     def deserialize(document):
@@ -52,3 +56,33 @@ class CartItem:
             )
 
         return None
+
+    @staticmethod
+    def deserialize_snapshot(uid, data):
+        """
+        Helper function for parsing an item embedded in a per-user cart
+        document to a CartItem object.
+
+        Parameters:
+           uid (str): The unique ID of the owner of the cart.
+           data (dict): An item from the items array of the cart document.
+
+        Output:
+           A CartItem object, with the embedded product snapshot as info.
+        """
+
+        item_id = data.get('item_id')
+        return CartItem(
+            item_id=item_id,
+            modify_time=data.get('modify_time'),
+            uid=uid,
+            info=Product(
+                id=item_id,
+                name=data.get('name'),
+                description=data.get('description'),
+                image=data.get('image'),
+                labels=[],
+                price=data.get('price'),
+                created_at=None
+            )
+        )
@@ -19,13 +19,57 @@ A collection of helper functions for cart related operations.
 
 
 from dataclasses import asdict
+import os
 import time
 
 from google.cloud import firestore
 
+from helpers import product_catalog
+from helpers.clients import firestore_client
+from helpers.instrumentation import track
 from .data_classes import CartItem
 
-firestore_client = firestore.Client()
+# Cart storage mode. 'per_line' stores one document per cart item in the
+# carts collection; 'per_user' stores one document per user in the
+# user_carts collection, embedding a snapshot of each product so that a cart
+# can be rendered with a single read.
+CART_STORAGE_MODE = os.environ.get('CART_STORAGE_MODE', 'per_line')
+
+
+def _per_user_mode():
+    return CART_STORAGE_MODE == 'per_user'
+
+
+def _snapshot(item_id, product, modify_time):
+    """
+    Builds the entry of an item embedded in a per-user cart document.
+    """
+    return {
+        'item_id': item_id,
+        'modify_time': modify_time,
+        'name': product.name,
+        'description': product.description,
+        'price': product.price,
+        'image': product.image
+    }
+
+
+def _merge_lines(transaction, query, items):
+    """
+    Merges per-line cart documents into the items of a per-user cart
+    document and deletes them, within a transaction. Returns the number of
+    documents merged.
+    """
+    lines = list(query.get(transaction=transaction))
+    line_items = [CartItem.deserialize(line) for line in lines]
+    products = product_catalog.get_products([item.item_id for item in line_items])
+    for item, product in zip(line_items, products):
+        if product:
+            items.append(_snapshot(item.item_id, product, item.modify_time))
+    items.sort(key=lambda item: item.get('modify_time') or 0, reverse=True)
+    for line in lines:
+        transaction.delete(line.reference)
+    return len(lines)
 
 
 def get_cart(uid):
@@ -36,11 +80,22 @@ def get_cart(uid):
        uid (str): The unique ID of an user.
 
     Output:
-       A list of CartItem.
+       A list of CartItem. In per-user mode the items carry a snapshot of
+       their products as info.
     """
 
+    if _per_user_mode():
+        with track('firestore', 'get', reads=1):
+            document = firestore_client.collection('user_carts').document(uid).get()
+        if not document.exists:
+            return migrate_cart(uid)
+        items = document.to_dict().get('items', [])
+        return [CartItem.deserialize_snapshot(uid, item) for item in items]
+
     cart = []
-    query_results = firestore_client.collection('carts').where('uid', '==', uid).order_by('modify_time', direction=firestore.Query.DESCENDING).get()
+    with track('firestore', 'query') as call:
+        query_results = list(firestore_client.collection('carts').where('uid', '==', uid).order_by('modify_time', direction=firestore.Query.DESCENDING).get())
+        call.reads = len(query_results)
     for result in query_results:
         item = CartItem.deserialize(result)
         cart.append(item)
@@ -64,7 +119,37 @@ def add_to_cart(uid, item_id):
         item_id=item_id,
         modify_time=int(time.time()))
 
-    firestore_client.collection('carts').document().set(asdict(item))
+    if _per_user_mode():
+        product = product_catalog.get_product(item_id)
+        if not product:
+            return
+
+        transaction = firestore_client.transaction()
+        reference = firestore_client.collection('user_carts').document(uid)
+        query = firestore_client.collection('carts').where('uid', '==', uid)
+
+        @firestore.transactional
+        def transactional_add_to_cart(transaction, reference):
+            document = reference.get(transaction=transaction)
+            items = (document.to_dict() or {}).get('items', [])
+            merged = 0
+            if not document.exists:
+                # The cart is not migrated yet; carry over its per-line
+                # documents, or they would no longer be read.
+                merged = _merge_lines(transaction, query, items)
+            items.insert(0, _snapshot(item_id, product, item.modify_time))
+            transaction.set(reference, {'uid': uid, 'items': items})
+            return merged
+
+        with track('firestore', 'transaction') as call:
+            merged = transactional_add_to_cart(transaction, reference)
+            call.reads = call.writes = merged + 1
+        return
+
+    data = asdict(item)
+    data.pop('info')
+    with track('firestore', 'set', writes=1):
+        firestore_client.collection('carts').document().set(data)
 
 
 def remove_from_cart(uid, item_id):
@@ -81,11 +166,95 @@ def remove_from_cart(uid, item_id):
 
     transaction = firestore_client.transaction()
 
+    if _per_user_mode():
+        reference = firestore_client.collection('user_carts').document(uid)
+
+        @firestore.transactional
+        def transactional_remove_from_user_cart(transaction, reference):
+            document = reference.get(transaction=transaction)
+            if not document.exists:
+                return
+            items = document.to_dict().get('items', [])
+            items = [item for item in items if item.get('item_id') != item_id]
+            transaction.update(reference, {'items': items})
+
+        with track('firestore', 'transaction', reads=1, writes=1):
+            transactional_remove_from_user_cart(transaction, reference)
+        return
+
+    query = firestore_client.collection('carts').where('uid', '==', uid).where('item_id', '==', item_id)
+
+    @firestore.transactional
+    def transactional_remove_from_cart(transaction, query):
+        results = list(query.get(transaction=transaction))
+        for result in results:
+            transaction.delete(result.reference)
+        return len(results)
+
+    with track('firestore', 'transaction') as call:
+        call.reads = call.writes = transactional_remove_from_cart(transaction, query)
+
+
+def migrate_cart(uid):
+    """
+    Helper function for moving the per-line cart documents of a user into a
+    per-user cart document. Carts are migrated on first read in per-user
+    mode; see migrate_carts for migrating all carts at once.
+
+    Parameters:
+       uid (str): The unique ID of an user.
+
+    Output:
+       A list of CartItem, in the per-user format.
+    """
+
+    reference = firestore_client.collection('user_carts').document(uid)
+    query = firestore_client.collection('carts').where('uid', '==', uid)
+
+    # Most users have no per-line cart documents; skip the transaction, and
+    # do not write an empty cart document, for them.
+    with track('firestore', 'query') as call:
+        call.reads = len(list(query.limit(1).get()))
+    if not call.reads:
+        return []
+
+    transaction = firestore_client.transaction()
+
     @firestore.transactional
-    def transactional_remove_from_cart(transaction, uid, item_id):
-        query_results = firestore_client.collection('carts').where('uid', '==', uid).where('item_id', '==', item_id).get()
-        for result in query_results:
-            reference = firestore_client.collection('carts').document(result.id)
-            transaction.delete(reference)
+    def transactional_migrate_cart(transaction, reference):
+        document = reference.get(transaction=transaction)
+        items = (document.to_dict() or {}).get('items', [])
+        merged = _merge_lines(transaction, query, items)
+        if merged:
+            # Otherwise, migrated concurrently.
+            transaction.set(reference, {'uid': uid, 'items': items})
+        return items, merged
 
-    transactional_remove_from_cart(transaction, uid, item_id)
+    with track('firestore', 'transaction') as call:
+        items, migrated = transactional_migrate_cart(transaction, reference)
+        call.reads = migrated + 1
+        call.writes = migrated + 1 if migrated else 0
+    return [CartItem.deserialize_snapshot(uid, item) for item in items]
+
+
+def migrate_carts():
+    """
+    Helper function for migrating all per-line cart documents to per-user
+    cart documents.
+
+    Parameters:
+       None.
+
+    Output:
+       The number of carts migrated.
+    """
+
+    uids = set()
+    with track('firestore', 'query') as call:
+        query_results = list(firestore_client.collection('carts').select(['uid']).get())
+        call.reads = len(query_results)
+    for result in query_results:
+        uids.add(result.to_dict().get('uid'))
+    for uid in uids:
+        migrate_cart(uid)
+    return len(uids)
@@ -0,0 +1,175 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+A registry of Google Cloud clients shared by all helper modules.
+
+Each client is created on first use, so that importing the app does not
+open any connections, and only once, so that all helpers share the same
+Firestore channel. Factories can be replaced, e.g. with clients for the
+local emulators or with in-memory fakes.
+"""
+
+
+import functools
+import logging
+import os
+import threading
+import time
+
+GCP_PROJECT = os.environ.get('GCP_PROJECT')
+FIRESTORE_EMULATOR_HOST = os.environ.get('FIRESTORE_EMULATOR_HOST')
+# Batch settings of the Pub/Sub publisher. A batch is sent once it holds
+# PUBSUB_BATCH_MAX_MESSAGES messages or PUBSUB_BATCH_MAX_BYTES bytes, or
+# PUBSUB_BATCH_MAX_LATENCY seconds after its first message.
+PUBSUB_BATCH_MAX_MESSAGES = int(os.environ.get('PUBSUB_BATCH_MAX_MESSAGES', 100))
+PUBSUB_BATCH_MAX_BYTES = int(os.environ.get('PUBSUB_BATCH_MAX_BYTES', 1024 * 1024))
+PUBSUB_BATCH_MAX_LATENCY = float(os.environ.get('PUBSUB_BATCH_MAX_LATENCY', 0.05))
+# The maximum number of spans waiting to be exported, beyond which spans are
+# dropped, and the maximum number of spans exported at a time.
+TRACE_EXPORT_QUEUE_SIZE = int(os.environ.get('TRACE_EXPORT_QUEUE_SIZE', 1000))
+TRACE_EXPORT_BATCH_SIZE = int(os.environ.get('TRACE_EXPORT_BATCH_SIZE', 50))
+
+logger = logging.getLogger(__name__)
+
+_clients = {}
+_construction_times = {}
+_lock = threading.RLock()
+
+
+def _create_firestore_client():
+    from google.cloud import firestore
+    if FIRESTORE_EMULATOR_HOST:
+        # The emulator does not check credentials; the client library
+        # connects to FIRESTORE_EMULATOR_HOST.
+        from google.auth.credentials import AnonymousCredentials
+        return firestore.Client(project=GCP_PROJECT or 'emulator',
+                                credentials=AnonymousCredentials())
+    return firestore.Client()
+
+
+def _create_publisher_client():
+    # The client library connects to PUBSUB_EMULATOR_HOST, if set.
+    from google.cloud import pubsub_v1
+    batch_settings = pubsub_v1.types.BatchSettings(
+        max_bytes=PUBSUB_BATCH_MAX_BYTES,
+        max_latency=PUBSUB_BATCH_MAX_LATENCY,
+        max_messages=PUBSUB_BATCH_MAX_MESSAGES
+    )
+    return pubsub_v1.PublisherClient(batch_settings=batch_settings)
+
+
+def _create_firebase_app():
+    # See https://firebase.google.com/docs/admin/setup for more information.
+    import firebase_admin
+    return firebase_admin.initialize_app()
+
+
+def _create_trace_exporter():
+    # Spans are exported in batches from a background thread, off the
+    # request path; see helpers/instrumentation/trace_transport.py.
+    from opencensus.trace.exporters import stackdriver_exporter
+    from helpers.instrumentation import trace_transport
+    transport = functools.partial(trace_transport.BoundedBackgroundTransport,
+                                  max_queue_size=TRACE_EXPORT_QUEUE_SIZE,
+                                  max_batch_size=TRACE_EXPORT_BATCH_SIZE)
+    return stackdriver_exporter.StackdriverExporter(transport=transport)
+
+
+_factories = {
+    'firestore': _create_firestore_client,
+    'publisher': _create_publisher_client,
+    'firebase': _create_firebase_app,
+    'trace_exporter': _create_trace_exporter
+}
+
+
+def get_client(name):
+    """
+    Helper function for getting a shared client, creating it on first use.
+
+    Parameters:
+       name (str): The name of the client: 'firestore', 'publisher',
+                   'firebase' or 'trace_exporter'.
+
+    Output:
+       The client.
+    """
+
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            started_at = time.monotonic()
+            client = _factories[name]()
+            _construction_times[name] = time.monotonic() - started_at
+            logger.info('Created %s client in %.1f ms', name,
+                        _construction_times[name] * 1000)
+            _clients[name] = client
+    return client
+
+
+def register_factory(name, factory):
+    """
+    Helper function for replacing the factory of a client, e.g. with one
+    creating clients for the local emulators or in-memory fakes. A client
+    created by the previous factory is discarded.
+
+    Parameters:
+       name (str): The name of the client.
+       factory (func): A function with no arguments returning the client.
+
+    Output:
+       None.
+    """
+
+    with _lock:
+        _factories[name] = factory
+        _clients.pop(name, None)
+        _construction_times.pop(name, None)
+
+
+def construction_times():
+    """
+    Helper function for reporting how long it took to create each client.
+
+    Parameters:
+       None.
+
+    Output:
+       A dict of durations in seconds, by client name.
+    """
+
+    return dict(_construction_times)
+
+
+class LazyClient:
+    """
+    A stand-in for a shared client, which is looked up in the registry
+    whenever one of its attributes is used.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return getattr(get_client(self._name), attribute)
+
+
+firestore_client = LazyClient('firestore')
+publisher_client = LazyClient('publisher')
@@ -0,0 +1,94 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+A collection of helper functions for running independent backend calls
+concurrently on a shared, bounded thread pool.
+"""
+
+
+from concurrent import futures
+import logging
+import os
+import time
+
+from helpers import instrumentation
+
+THREAD_POOL_SIZE = int(os.environ.get('THREAD_POOL_SIZE', 8))
+
+executor = futures.ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+def submit(name, fn, *args, **kwargs):
+    """
+    Helper function for running a function on the shared thread pool. The
+    duration of the call is logged when it completes. The function is bound
+    to the current request, so that its backend calls are accounted and
+    traced (see helpers/instrumentation).
+
+    Parameters:
+       name (str): The name of the call, used in logs.
+       fn (func): The function to run.
+       *args, **kwargs: The arguments to pass to the function.
+
+    Output:
+       A Future for the result of the call.
+    """
+
+    submitted_at = time.monotonic()
+
+    def timed_call():
+        started_at = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            finished_at = time.monotonic()
+            logger.info('%s took %.1f ms (queued %.1f ms)', name,
+                        (finished_at - started_at) * 1000,
+                        (started_at - submitted_at) * 1000)
+
+    future = executor.submit(instrumentation.bind(timed_call))
+    future.name = name
+    future.submitted_at = submitted_at
+    return future
+
+
+def result_or_default(future, timeout, default):
+    """
+    Helper function for getting the result of a call submitted with submit,
+    falling back to a default value if the call fails or does not complete
+    within the timeout.
+
+    Parameters:
+       future (Future): A Future returned by submit.
+       timeout (float): The time budget of the call in seconds, counted from
+                        its submission.
+       default: The value to return if the call fails or times out.
+
+    Output:
+       The result of the call, or default.
+    """
+
+    remaining = timeout - (time.monotonic() - future.submitted_at)
+    try:
+        return future.result(timeout=max(remaining, 0))
+    except futures.TimeoutError:
+        logger.warning('%s did not complete within %.1f ms', future.name,
+                       timeout * 1000)
+    except Exception:
+        logger.exception('%s failed', future.name)
+    return default
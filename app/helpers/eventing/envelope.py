@@ -0,0 +1,121 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Encoding and decoding of event envelopes.
+
+Two encodings are supported:
+
+* json: {"event_type": ..., "created_time": "<seconds>", "event_context": ...}
+  as UTF-8 JSON. This is the default, and the only encoding the Node.js
+  subscribers (streamEvents, sendOrderConfirmation) understand.
+* msgpack-v1: the MessagePack array
+  [1, event_type, created_time_ms, event_context], announced with the
+  message attribute encoding=msgpack-v1.
+
+Messages without an encoding attribute are decoded as JSON.
+
+Cloud Functions automl, detect_labels and pay_with_stripe hold copies of
+this module, as each is deployed from its own directory; test
+test_shared_module_copies in app/main_test.py checks that they match.
+"""
+
+
+import base64
+import json
+import time
+
+import msgpack
+
+JSON = 'json'
+MSGPACK_V1 = 'msgpack-v1'
+ENCODING_ATTRIBUTE = 'encoding'
+
+
+def encode(event_type, event_context, encoding=JSON):
+    """
+    Helper function for encoding an event.
+
+    Parameters:
+       event_type (str): The type of the event.
+       event_context (dict): The context of the event.
+       encoding (str): The encoding, JSON or MSGPACK_V1.
+
+    Output:
+       A tuple of the message data (bytes) and the message attributes (dict).
+    """
+
+    created_time_ms = int(time.time() * 1000)
+    if encoding == MSGPACK_V1:
+        data = msgpack.packb([1, event_type, created_time_ms, event_context],
+                             use_bin_type=True)
+        return data, {ENCODING_ATTRIBUTE: MSGPACK_V1}
+
+    if encoding != JSON:
+        raise ValueError(f'Unsupported event encoding: {encoding}')
+    data = json.dumps({
+        'event_type': event_type,
+        'created_time': str(created_time_ms // 1000),
+        'event_context': event_context
+    }).encode()
+    return data, {}
+
+
+def decode(data, attributes=None):
+    """
+    Helper function for decoding an event.
+
+    Parameters:
+       data (bytes): The message data.
+       attributes (dict): The message attributes.
+
+    Output:
+       A dict with keys event_type, created_time (seconds, str),
+       created_time_ms (int; None for JSON events) and event_context.
+    """
+
+    encoding = (attributes or {}).get(ENCODING_ATTRIBUTE, JSON)
+    if encoding == MSGPACK_V1:
+        version, event_type, created_time_ms, event_context = msgpack.unpackb(data, raw=False)
+        if version != 1:
+            raise ValueError(f'Unsupported event envelope version: {version}')
+        return {
+            'event_type': event_type,
+            'created_time': str(created_time_ms // 1000),
+            'created_time_ms': created_time_ms,
+            'event_context': event_context
+        }
+
+    if encoding != JSON:
+        raise ValueError(f'Unsupported event encoding: {encoding}')
+    request = json.loads(data.decode() if isinstance(data, bytes) else data)
+    request.setdefault('created_time_ms', None)
+    return request
+
+
+def decode_pubsub_message(message):
+    """
+    Helper function for decoding an event delivered to a background Cloud
+    Function.
+
+    Parameters:
+       message (dict): The Pub/Sub message, with base64-encoded data and
+                       optional attributes.
+
+    Output:
+       The decoded event; see decode.
+    """
+
+    return decode(base64.b64decode(message.get('data')), message.get('attributes'))
@@ -18,34 +18,140 @@ A collection of helper functions for streaming events.
 """
 
 
+import atexit
+from concurrent import futures
 import os
-import json
+import logging
+import threading
 import time
 
-from google.cloud import pubsub_v1
-
-publisher = pubsub_v1.PublisherClient()
+from helpers.clients import publisher_client
+from helpers.instrumentation import track
+from . import envelope
 
 GCP_PROJECT = os.environ.get('GCP_PROJECT')
+# The encoding of events, json or msgpack-v1. See envelope.py for more
+# information; only switch to msgpack-v1 if all subscribers of the topics
+# decode it.
+EVENT_ENCODING = os.environ.get('EVENT_ENCODING', envelope.JSON)
+# The maximum number of events waiting to be delivered. Publishing blocks
+# for up to PUBSUB_FLOW_CONTROL_TIMEOUT seconds while the limit is reached;
+# the event is dropped afterwards.
+PUBSUB_MAX_IN_FLIGHT = int(os.environ.get('PUBSUB_MAX_IN_FLIGHT', 1000))
+PUBSUB_FLOW_CONTROL_TIMEOUT = float(os.environ.get('PUBSUB_FLOW_CONTROL_TIMEOUT', 5))
+# How long to wait for events in flight to be delivered on shutdown.
+PUBSUB_SHUTDOWN_TIMEOUT = float(os.environ.get('PUBSUB_SHUTDOWN_TIMEOUT', 10))
+
+logger = logging.getLogger(__name__)
+
+# Delivery counters: events published, events that failed to publish, and
+# events dropped by flow control.
+metrics = {'published': 0, 'failed': 0, 'dropped': 0}
+
+_topic_paths = {}
+_in_flight = set()
+_in_flight_slots = threading.BoundedSemaphore(PUBSUB_MAX_IN_FLIGHT)
+_lock = threading.Lock()
+
+
+def _topic_path(topic_name):
+    topic_path = _topic_paths.get(topic_name)
+    if topic_path is None:
+        topic_path = _topic_paths[topic_name] = publisher_client.topic_path(GCP_PROJECT, topic_name)
+    return topic_path
+
 
-def stream_event(topic_name, event_type, event_context):
+def _on_delivery(future, topic_name, event_type, callback):
     """
-    Helper function for publishing an event.
+    Records the outcome of a publish call and releases its flow control slot.
+    """
+    error = future.exception()
+    with _lock:
+        _in_flight.discard(future)
+        if error:
+            metrics['failed'] += 1
+        else:
+            metrics['published'] += 1
+    _in_flight_slots.release()
+
+    if error:
+        logger.error('Failed to publish %s event to %s: %s', event_type, topic_name, error)
+    if callback:
+        try:
+            callback(future)
+        except Exception:
+            logger.exception('Delivery callback for %s event failed', event_type)
+
+
+def stream_event(topic_name, event_type, event_context, callback=None):
+    """
+    Helper function for publishing an event. Events are sent in batches in
+    the background; see helpers/clients for the batch settings.
 
     Parameters:
        topic_name (str): The name of the Cloud Pub/Sub topic.
        event_type (str): The type of the event.
        event_context: The context of the event.
+       callback (func): Optional. Called with the future of the publish call
+                        once the event is delivered or fails.
 
     Output:
-       None.
+       The future of the publish call, or None if the event was dropped by
+       flow control.
     """
 
-    topic_path = publisher.topic_path(GCP_PROJECT, topic_name)
-    request = {
-        'event_type': event_type,
-        'created_time': str(int(time.time())),
-        'event_context': event_context
-    }
-    data = json.dumps(request).encode()
-    publisher.publish(topic_path, data)
+    data, attributes = envelope.encode(event_type, event_context, EVENT_ENCODING)
+
+    if not _in_flight_slots.acquire(timeout=PUBSUB_FLOW_CONTROL_TIMEOUT):
+        with _lock:
+            metrics['dropped'] += 1
+        logger.error('Dropped %s event to %s: too many events in flight', event_type, topic_name)
+        return None
+
+    try:
+        # Publishing only adds the event to a batch; the time recorded does
+        # not include delivery.
+        with track('pubsub', 'publish', writes=1):
+            future = publisher_client.publish(_topic_path(topic_name), data, **attributes)
+    except Exception:
+        _in_flight_slots.release()
+        raise
+
+    with _lock:
+        _in_flight.add(future)
+    future.add_done_callback(
+        lambda future: _on_delivery(future, topic_name, event_type, callback))
+    return future
+
+
+def flush(timeout=PUBSUB_SHUTDOWN_TIMEOUT):
+    """
+    Helper function for waiting until all events in flight are delivered.
+    Called automatically when the instance shuts down.
+
+    Parameters:
+       timeout (float): The maximum time to wait, in seconds.
+
+    Output:
+       The number of events still in flight after the timeout.
+    """
+
+    with _lock:
+        pending = list(_in_flight)
+
+    deadline = time.monotonic() + timeout
+    not_done = 0
+    for future in pending:
+        try:
+            future.result(timeout=max(deadline - time.monotonic(), 0))
+        except futures.TimeoutError:
+            not_done += 1
+        except Exception:
+            # Failures are logged by _on_delivery.
+            pass
+    if not_done:
+        logger.error('%d events were still in flight after %.1f s', not_done, timeout)
+    return not_done
+
+
+atexit.register(flush)
@@ -0,0 +1,265 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+A collection of helper functions for accounting the backend calls made
+while serving a request.
+
+Helper modules wrap each Firestore and Pub/Sub call in track. The calls are
+recorded in the RequestStats of the current request, if any, and, once
+tracing is enabled, traced as child spans of the current OpenCensus span;
+see middlewares/request_metrics and middlewares/tracing. Functions run on
+the shared thread pool (see helpers/concurrency) are bound to the request
+that submitted them.
+"""
+
+
+from contextlib import contextmanager, nullcontext
+import contextvars
+import threading
+import time
+
+_current_stats = contextvars.ContextVar('request_stats', default=None)
+# The OpenCensus execution context, once tracing is enabled. OpenCensus is
+# slow to import, so it is not imported until then.
+_execution_context = None
+
+
+class BackendCall:
+    """
+    A backend call in progress. Set reads and writes to the number of
+    documents or messages the call read or wrote, if not known upfront.
+    """
+
+    def __init__(self, backend, operation, reads=0, writes=0):
+        self.backend = backend
+        self.operation = operation
+        self.reads = reads
+        self.writes = writes
+
+
+class RequestStats:
+    """
+    The backend calls made while serving a request, by backend.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def record(self, call, duration):
+        with self._lock:
+            stats = self._backends.setdefault(call.backend, {
+                'calls': 0,
+                'reads': 0,
+                'writes': 0,
+                'time_ms': 0.0
+            })
+            stats['calls'] += 1
+            stats['reads'] += call.reads
+            stats['writes'] += call.writes
+            stats['time_ms'] += duration * 1000
+
+    def backends(self):
+        """
+        Returns a dict of calls, reads, writes and time spent (time_ms), by
+        backend.
+        """
+        with self._lock:
+            return {
+                backend: dict(stats, time_ms=round(stats['time_ms'], 2))
+                for backend, stats in self._backends.items()
+            }
+
+    def total(self, field):
+        """
+        Returns the sum of a field of backends() across all backends.
+        """
+        with self._lock:
+            return sum(stats[field] for stats in self._backends.values())
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started_at) * 1000
+
+
+def start_request():
+    """
+    Helper function for starting the accounting of a request.
+
+    Parameters:
+       None.
+
+    Output:
+       A tuple of the RequestStats of the request and a token for
+       end_request.
+    """
+
+    stats = RequestStats()
+    return stats, _current_stats.set(stats)
+
+
+def end_request(token):
+    """
+    Helper function for ending the accounting of a request.
+
+    Parameters:
+       token: The token returned by start_request.
+
+    Output:
+       None.
+    """
+
+    _current_stats.reset(token)
+
+
+def current_stats():
+    """
+    Helper function for getting the RequestStats of the current request.
+
+    Parameters:
+       None.
+
+    Output:
+       A RequestStats object, or None outside of a request.
+    """
+
+    return _current_stats.get()
+
+
+def enable_tracing():
+    """
+    Helper function for tracing backend calls and spans as part of the
+    trace of the current request. Called by middlewares/tracing.
+
+    Parameters:
+       None.
+
+    Output:
+       None.
+    """
+
+    global _execution_context
+    from opencensus.trace import execution_context
+    _execution_context = execution_context
+
+
+def span(name):
+    """
+    Helper function for tracing a block of code as a child span of the
+    current span. Use as a context manager:
+
+        with span('prepare_order_info'):
+            ...
+
+    Parameters:
+       name (str): The name of the span.
+
+    Output:
+       A context manager, which yields the span, or None if tracing is not
+       enabled.
+    """
+
+    if _execution_context is None:
+        return nullcontext()
+    return _execution_context.get_opencensus_tracer().span(name=name)
+
+
+def trace_id():
+    """
+    Helper function for getting the ID of the trace of the current request.
+
+    Parameters:
+       None.
+
+    Output:
+       The trace ID (str), or None if tracing is not enabled.
+    """
+
+    if _execution_context is None:
+        return None
+    return _execution_context.get_opencensus_tracer().span_context.trace_id
+
+
+@contextmanager
+def track(backend, operation, reads=0, writes=0):
+    """
+    Helper function for recording a backend call in the RequestStats of the
+    current request and tracing it as a span. Use as a context manager
+    around the call:
+
+        with track('firestore', 'query') as call:
+            documents = list(query.get())
+            call.reads = len(documents)
+
+    Parameters:
+       backend (str): The name of the backend, e.g. 'firestore'.
+       operation (str): The name of the operation, e.g. 'get_all'.
+       reads (int): The number of documents read, if known upfront.
+       writes (int): The number of documents or messages written, if known
+                     upfront.
+
+    Output:
+       A BackendCall object.
+    """
+
+    call = BackendCall(backend, operation, reads=reads, writes=writes)
+    with span(f'{backend}.{operation}') as current_span:
+        started_at = time.perf_counter()
+        try:
+            yield call
+        finally:
+            stats = _current_stats.get()
+            if stats is not None:
+                stats.record(call, time.perf_counter() - started_at)
+            if current_span is not None:
+                current_span.add_attribute('reads', call.reads)
+                current_span.add_attribute('writes', call.writes)
+
+
+def bind(fn):
+    """
+    Helper function for binding a function to the current request, so that
+    the backend calls it makes on another thread are accounted to the
+    request and traced as children of the current span.
+
+    Parameters:
+       fn (func): A function with no arguments.
+
+    Output:
+       A function with no arguments, which calls fn.
+    """
+
+    context = contextvars.copy_context()
+    execution_context = _execution_context
+    if execution_context is None:
+        return lambda: context.run(fn)
+
+    tracer = execution_context.get_opencensus_tracer()
+    current_span = execution_context.get_current_span()
+
+    def bound():
+        # OpenCensus keeps the current tracer and span in thread locals.
+        previous_tracer = execution_context.get_opencensus_tracer()
+        previous_span = execution_context.get_current_span()
+        execution_context.set_opencensus_tracer(tracer)
+        execution_context.set_current_span(current_span)
+        try:
+            return context.run(fn)
+        finally:
+            execution_context.set_opencensus_tracer(previous_tracer)
+            execution_context.set_current_span(previous_span)
+
+    return bound
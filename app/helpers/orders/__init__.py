@@ -15,3 +15,4 @@
 
 from .helpers import *
 from .data_classes import Shipping, Order
+from .order_status import *
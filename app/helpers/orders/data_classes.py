@@ -71,6 +71,9 @@ class Order:
     status: str
     items: List[str]
     id: str = None
+    # The user whose cart the items were checked out from, if any. Cloud
+    # Function pay_with_stripe removes them from the cart once paid.
+    cart_uid: str = None
 
 
     @staticmethod
@@ -91,7 +94,8 @@ class Order:
                 amount=data.get('amount'),
                 shipping=Shipping.deserialize(data.get('shipping')),
                 status=data.get('status'),
-                items=data.get('items')
+                items=data.get('items'),
+                cart_uid=data.get('cart_uid')
             )
 
         return None
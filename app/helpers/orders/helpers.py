@@ -21,11 +21,10 @@ A collection of helper functions for order related operations.
 from dataclasses import asdict
 import uuid
 
-from google.cloud import firestore
-
+from helpers.clients import firestore_client
+from helpers.instrumentation import track
 from .data_classes import Order
 
-firestore = firestore.Client()
 
 def add_order(order):
     """
@@ -39,7 +38,8 @@ def add_order(order):
     """
 
     order_id = uuid.uuid4().hex
-    firestore.collection('orders').document(order_id).set(asdict(order))
+    with track('firestore', 'set', writes=1):
+        firestore_client.collection('orders').document(order_id).set(asdict(order))
     return order_id
 
 
@@ -54,5 +54,6 @@ def get_order(order_id):
        An Order object.
     """
 
-    order_data = firestore.collection('orders').document(order_id).get()
+    with track('firestore', 'get', reads=1):
+        order_data = firestore_client.collection('orders').document(order_id).get()
     return Order.deserialize(order_data)
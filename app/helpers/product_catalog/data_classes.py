@@ -19,7 +19,7 @@ Data class for products.
 
 
 from dataclasses import dataclass
-from typing import List
+from typing import Dict, List
 
 
 @dataclass
@@ -70,6 +70,7 @@ class PromoEntry:
     label: str
     score: float
     id: str = None
+    scores: Dict[str, float] = None
 
 
     @staticmethod
@@ -88,7 +89,8 @@ class PromoEntry:
             return PromoEntry(
                 id=document.id,
                 label=data.get('label'),
-                score=data.get('score')
+                score=data.get('score'),
+                scores=data.get('scores')
             )
 
         return None
@@ -18,17 +18,226 @@ A collection of helper functions for product related operations.
 """
 
 
-from dataclasses import asdict
+import base64
+import binascii
+from dataclasses import asdict, replace
+from decimal import Decimal, ROUND_HALF_UP
+import json
+import logging
 import os
+import threading
+import time
 import uuid
 
 from google.cloud import firestore
 
+from helpers import concurrency
+from helpers.caching import LRUCache
+from helpers.clients import firestore_client
+from helpers.instrumentation import track
 from .data_classes import Product, PromoEntry
 
 BUCKET = os.environ.get('GCS_BUCKET')
+PRODUCT_CACHE_SIZE = int(os.environ.get('PRODUCT_CACHE_SIZE', 1024))
+PRODUCT_CACHE_TTL = float(os.environ.get('PRODUCT_CACHE_TTL', 300))
+# Set PRODUCT_CACHE_WATCH to 1 to keep the caches in sync with a snapshot
+# listener on the products collection instead of relying on the TTL alone. The first snapshot of a listener reads, and keeps in memory,
+# every document of the collection, and every write to it is then streamed
+# to every instance; only enable it for small catalogs.
+PRODUCT_CACHE_WATCH = os.environ.get('PRODUCT_CACHE_WATCH') == '1'
+# Default label, minimum score and size of the promotion rail.
+PROMO_LABEL = os.environ.get('PROMO_LABEL', 'pets')
+PROMO_MIN_SCORE = float(os.environ.get('PROMO_MIN_SCORE', 0.7))
+PROMO_SIZE = int(os.environ.get('PROMO_SIZE', 3))
+PROMO_FEED_TTL = float(os.environ.get('PROMO_FEED_TTL', 300))
+# Each promotion feed is kept in sync with a snapshot listener on its own
+# query, which only reads and streams the few entries of the feed. Set
+# PROMO_FEED_WATCH to 0 to rely on PROMO_FEED_TTL alone.
+PROMO_FEED_WATCH = os.environ.get('PROMO_FEED_WATCH', '1') == '1'
+IMAGE_URL_TEMPLATE = 'https://storage.cloud.google.com/{}/{}'
+# Set IMAGE_DERIVATIVES to 1 once the derivatives of all product images are
+# saved by Cloud Function upload_image (see its backfill.py). IMAGE_SIZES and
+# IMAGE_FORMATS must match the sizes and formats it saves, in order of
+# preference; it skips the formats its ImageMagick cannot encode. Pages fall
+# back to the original image if a derivative is missing.
+IMAGE_DERIVATIVES = os.environ.get('IMAGE_DERIVATIVES') == '1'
+IMAGE_SIZES = [int(size) for size in os.environ.get('IMAGE_SIZES', '160,320,640').split(',')]
+IMAGE_FORMATS = os.environ.get('IMAGE_FORMATS', 'webp').split(',')
+
+# Products by ID, and product listings by query.
+product_cache = LRUCache(max_size=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL)
+listing_cache = LRUCache(max_size=16, ttl=PRODUCT_CACHE_TTL)
+# Ready-to-render promoted products by (label, min_score, size).
+promo_feed = LRUCache(max_size=32, ttl=PROMO_FEED_TTL)
+
+# Prices of all products in integer cents, by product ID.
+price_index = {}
+_price_index_loaded_at = None
+_price_index_lock = threading.Lock()
+_price_index_refreshing = False
+_price_index_refresh_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+_watches = {}
+_watch_lock = threading.Lock()
+
+
+class ProductNotFoundError(Exception):
+    """
+    Raised when pricing products that do not exist.
+    """
+
+    def __init__(self, product_ids):
+        super().__init__(f'Products not found: {", ".join(product_ids)}')
+        self.product_ids = product_ids
+
+
+def to_cents(price):
+    """
+    Helper function for converting a price in dollars to integer cents.
+
+    Parameters:
+       price (float): A price in dollars.
+
+    Output:
+       The price in cents (int).
+    """
+
+    cents = Decimal(str(price)) * 100
+    return int(cents.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def _on_products_snapshot(documents, changes, read_time):
+    """
+    Callback for the snapshot listener on the products collection. Keeps
+    cached products in sync with Firestore, e.g. after Cloud Function
+    detect_labels rewrites the labels of a product.
+    """
+    for change in changes:
+        product_id = change.document.id
+        if change.type.name == 'REMOVED':
+            product_cache.delete(product_id)
+            price_index.pop(product_id, None)
+            continue
+
+        price = change.document.to_dict().get('price')
+        if price is not None:
+            price_index[product_id] = to_cents(price)
+        if change.type.name == 'MODIFIED' and product_id in product_cache:
+            product = Product.deserialize(change.document)
+            product_cache.set(product_id, product)
+            _update_promo_feed(product)
+    if changes:
+        listing_cache.clear()
+
+
+def _watch_products():
+    """
+    Starts the snapshot listener on the products collection on first use.
+    """
+    if not PRODUCT_CACHE_WATCH or 'products' in _watches:
+        return
 
-firestore_client = firestore.Client()
+    with _watch_lock:
+        if 'products' not in _watches:
+            query = firestore_client.collection('products')
+            _watches['products'] = query.on_snapshot(_on_products_snapshot)
+
+
+def _watch_promo_feed(key):
+    """
+    Starts a snapshot listener on the query of a promotion feed on first use.
+    The feed is rebuilt from every snapshot, e.g. after Cloud Function automl
+    scores a product. At most as many feeds as promo_feed holds are watched;
+    the others rely on PROMO_FEED_TTL.
+    """
+    if not PROMO_FEED_WATCH or key in _watches:
+        return
+
+    def on_snapshot(documents, changes, read_time):
+        entries = [PromoEntry.deserialize(document) for document in documents]
+        try:
+            _build_promo_feed(*key, entries=entries)
+        except Exception:
+            promo_feed.delete(key)
+
+    with _watch_lock:
+        watched = sum(1 for watch_key in _watches if watch_key != 'products')
+        if key not in _watches and watched < promo_feed.max_size:
+            _watches[key] = _promo_query(*key).on_snapshot(on_snapshot)
+
+
+def cache_stats():
+    """
+    Helper function for reporting the usage of the product caches.
+
+    Parameters:
+       None.
+
+    Output:
+       A dict of cache statistics, keyed by cache name.
+    """
+
+    return {
+        'products': product_cache.stats(),
+        'listings': listing_cache.stats(),
+        'promos': promo_feed.stats()
+    }
+
+
+def image_url(image, size=None, format='png'):
+    """
+    Helper function for building the URL of a product image.
+
+    Parameters:
+       image (str): The ID of the image, as returned by Cloud Function
+                    upload_image.
+       size (int): The width of the derivative, in pixels. If None, the URL
+                   of the 640x640 PNG is returned.
+       format (str): The format of the derivative.
+
+    Output:
+       The URL of the image.
+    """
+
+    if size is None:
+        filename = f'{image}.png'
+    else:
+        filename = f'{image}_{size}.{format}'
+    return IMAGE_URL_TEMPLATE.format(BUCKET, filename)
+
+
+def image_srcset(image, format='png'):
+    """
+    Helper function for building the srcset attribute of a product image.
+
+    Parameters:
+       image (str): The ID of the image.
+       format (str): The format of the derivatives.
+
+    Output:
+       The srcset, or an empty string if derivatives are disabled.
+    """
+
+    if not IMAGE_DERIVATIVES:
+        return ''
+    return ', '.join(f'{image_url(image, size, format)} {size}w' for size in IMAGE_SIZES)
+
+
+def image_formats():
+    """
+    Helper function for listing the formats of the derivatives of product
+    images besides PNG, in order of preference.
+
+    Parameters:
+       None.
+
+    Output:
+       A list of formats, empty if derivatives are disabled.
+    """
+
+    return IMAGE_FORMATS if IMAGE_DERIVATIVES else []
 
 
 def add_product(product):
@@ -43,7 +252,11 @@ def add_product(product):
     """
 
     product_id = uuid.uuid4().hex
-    firestore_client.collection('products').document(product_id).set(asdict(product))
+    with track('firestore', 'set', writes=1):
+        firestore_client.collection('products').document(product_id).set(asdict(product))
+    product_cache.set(product_id, replace(product, id=product_id))
+    listing_cache.clear()
+    price_index[product_id] = to_cents(product.price)
     return product_id
 
 def get_product(product_id):
@@ -57,61 +270,364 @@ def get_product(product_id):
        A Product object.
     """
 
-    product = firestore_client.collection('products').document(product_id).get()
-    return Product.deserialize(product)
+    _watch_products()
+    product = product_cache.get(product_id)
+    if product:
+        return product
+
+    with track('firestore', 'get', reads=1):
+        product = firestore_client.collection('products').document(product_id).get()
+    product = Product.deserialize(product)
+    if product:
+        product_cache.set(product_id, product)
+    return product
+
+
+def get_products(product_ids):
+    """
+    Helper function for getting multiple products in one batched read.
+
+    Parameters:
+       product_ids (List[str]): A list of product IDs. Duplicate IDs are
+                                fetched only once.
+
+    Output:
+       A list of Product objects in the same order as product_ids; the
+       entry is None if the product does not exist.
+    """
+
+    _watch_products()
+    products = {}
+    missing_ids = []
+    for product_id in dict.fromkeys(product_ids):
+        product = product_cache.get(product_id)
+        if product:
+            products[product_id] = product
+        else:
+            missing_ids.append(product_id)
+
+    if missing_ids:
+        references = [
+            firestore_client.collection('products').document(product_id)
+            for product_id in missing_ids
+        ]
+        with track('firestore', 'get_all', reads=len(references)):
+            documents = list(firestore_client.get_all(references))
+        for document in documents:
+            product = Product.deserialize(document)
+            if product:
+                products[document.id] = product
+                product_cache.set(document.id, product)
+
+    return [products.get(product_id) for product_id in product_ids]
+
+
+def encode_cursor(product):
+    """
+    Helper function for building a pagination cursor pointing at a product.
+
+    Parameters:
+       product (Product): The last product of a page.
+
+    Output:
+       An opaque, URL-safe cursor string.
+    """
+
+    data = json.dumps([product.created_at, product.id]).encode()
+    return base64.urlsafe_b64encode(data).decode()
 
 
-def list_products():
+def decode_cursor(cursor):
+    """
+    Helper function for parsing a pagination cursor.
+
+    Parameters:
+       cursor (str): A cursor built by encode_cursor.
+
+    Output:
+       A tuple of the created_at and ID of the product the cursor points at.
+       Raises ValueError if the cursor is malformed.
+    """
+
+    try:
+        created_at, product_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    if not isinstance(product_id, str):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return created_at, product_id
+
+
+def _query_products(page_size=None, cursor=None):
+    """
+    Runs a query over the products collection, ordered by creation time and
+    then by ID so that products created in the same second keep a stable
+    order across pages.
+    """
+    collection = firestore_client.collection('products')
+    query = collection.order_by('created_at').order_by('__name__')
+    if cursor:
+        created_at, product_id = decode_cursor(cursor)
+        query = query.start_after({
+            'created_at': created_at,
+            '__name__': collection.document(product_id)
+        })
+    if page_size:
+        query = query.limit(page_size)
+    with track('firestore', 'query') as call:
+        documents = list(query.get())
+        call.reads = len(documents)
+    return documents
+
+
+def list_products(page_size=None, cursor=None):
     """
     Helper function for listing products.
 
     Parameters:
-       None.
+       page_size (int): The maximum number of products to return. Lists
+                        all products if not set.
+       cursor (str): A cursor built by encode_cursor; the listing starts
+                     after the product it points at.
 
     Output:
-       A list of Product objects.
+       A list of Product objects. If the list has page_size items, pass
+       encode_cursor(products[-1]) to get the next page.
     """
 
-    products = firestore_client.collection('products').order_by('created_at').get()
-    product_list = [Product.deserialize(product) for product in list(products)]
+    _watch_products()
+    key = (page_size, cursor)
+    product_list = listing_cache.get(key)
+    if product_list is not None:
+        return product_list
+
+    products = _query_products(page_size=page_size, cursor=cursor)
+    product_list = [Product.deserialize(product) for product in products]
+    for product in product_list:
+        product_cache.set(product.id, product)
+    listing_cache.set(key, product_list)
     return product_list
 
 
+def stream_products(batch_size=500):
+    """
+    Helper function for iterating over all products, fetching them from
+    Firestore one page at a time. Intended for batch jobs; products read
+    this way are not cached.
+
+    Parameters:
+       batch_size (int): The number of products to fetch per query.
+
+    Output:
+       A generator of Product objects.
+    """
+
+    cursor = None
+    while True:
+        count = 0
+        for document in _query_products(page_size=batch_size, cursor=cursor):
+            product = Product.deserialize(document)
+            count += 1
+            yield product
+        if count < batch_size:
+            return
+        cursor = encode_cursor(product)
+
+
+def load_price_index(max_age=None):
+    """
+    Helper function for loading the prices of all products into the price
+    index, reading only the price field of each product.
+
+    Parameters:
+       max_age (float): If set, the index is not reloaded if it was loaded
+                        at most max_age seconds ago, e.g. by a concurrent
+                        call.
+
+    Output:
+       None.
+    """
+
+    global price_index, _price_index_loaded_at
+    with _price_index_lock:
+        if max_age is not None and _price_index_loaded_at is not None and \
+                time.monotonic() - _price_index_loaded_at <= max_age:
+            return
+        prices = {}
+        with track('firestore', 'query') as call:
+            documents = list(firestore_client.collection('products').select(['price']).get())
+            call.reads = len(documents)
+        for document in documents:
+            price = document.to_dict().get('price')
+            if price is not None:
+                prices[document.id] = to_cents(price)
+        # Swap the index in one step, so that readers never see it empty.
+        price_index = prices
+        _price_index_loaded_at = time.monotonic()
+
+
+def _refresh_price_index():
+    global _price_index_refreshing
+    try:
+        load_price_index(max_age=PRODUCT_CACHE_TTL)
+    except Exception:
+        logger.exception('Failed to reload the price index')
+    finally:
+        _price_index_refreshing = False
+
+
+def _schedule_price_index_refresh():
+    """
+    Reloads the price index on the shared thread pool, once at a time.
+    """
+    global _price_index_refreshing
+    with _price_index_refresh_lock:
+        if _price_index_refreshing:
+            return
+        _price_index_refreshing = True
+    concurrency.executor.submit(_refresh_price_index)
+
+
+def get_prices(product_ids):
+    """
+    Helper function for looking up the prices of products in the price index.
+    With PRODUCT_CACHE_WATCH, the snapshot listener on the products
+    collection fills the index; otherwise it is loaded on first use and
+    reloaded in the background once it is as old as the product cache TTL,
+    so that deleted products are not sold. Prices missing from it (e.g. products listed by
+    another instance) are fetched from Firestore.
+
+    Parameters:
+       product_ids (List[str]): A list of product IDs.
+
+    Output:
+       A dict of prices in integer cents, by product ID. Raises
+       ProductNotFoundError if any of the products does not exist.
+    """
+
+    if PRODUCT_CACHE_WATCH:
+        # The first snapshot lists every product; loading the index as well
+        # would read the whole collection twice.
+        _watch_products()
+    elif _price_index_loaded_at is None:
+        # Concurrent first calls wait for a single load.
+        load_price_index(max_age=PRODUCT_CACHE_TTL)
+    elif time.monotonic() - _price_index_loaded_at > PRODUCT_CACHE_TTL:
+        # Keep serving the current index while it is reloaded.
+        _schedule_price_index_refresh()
+
+    prices = {}
+    missing_ids = []
+    for product_id in dict.fromkeys(product_ids):
+        price = price_index.get(product_id)
+        if price is None:
+            missing_ids.append(product_id)
+        else:
+            prices[product_id] = price
+
+    if missing_ids:
+        for product_id, product in zip(missing_ids, get_products(missing_ids)):
+            if product and product.price is not None:
+                prices[product_id] = price_index[product_id] = to_cents(product.price)
+        missing_ids = [product_id for product_id in missing_ids if product_id not in prices]
+        if missing_ids:
+            raise ProductNotFoundError(missing_ids)
+
+    return prices
+
+
 def calculate_total_price(product_ids):
     """
     Helper function for calculating the total price of a list of products.
+    Prices are summed in integer cents.
 
     Parameters:
        product_ids (List[str]): A list of product IDs.
 
     Output:
-       The total price.
+       The total price in dollars. Raises ProductNotFoundError if any of the
+       products does not exist.
     """
 
-    total = 0
-    for product_id in product_ids:
-        product = get_product(product_id)
-        total += product.price
-    return total
+    prices = get_prices(product_ids)
+    total = sum(prices[product_id] for product_id in product_ids)
+    return total / 100
 
 
-def get_promos():
+def _promo_query(label, min_score, size):
+    """
+    Returns the query for the promoted products of a label. Products are
+    matched on the score of any of their top labels, not only the top one.
     """
-    Helper function for getting promoted products.
+    score_field = firestore.Client.field_path('scores', label)
+    query = firestore_client.collection('promos').where(score_field, '>=', min_score)
+    return query.order_by(score_field, direction=firestore.Query.DESCENDING).limit(size)
+
+
+def _build_promo_feed(label, min_score, size, entries=None):
+    """
+    Caches the promoted products for a label in the promotion feed, from the
+    given entries of the promo query, or from the results of the query.
+
+    Promotions written before automl kept the scores of the top labels only
+    hold the top label and its score; if too few products match, the feed
+    is completed with those matching on their top label. Those are not
+    watched: automl writes the scores of all top labels when it rescores
+    a product.
+    """
+    if entries is None:
+        with track('firestore', 'query') as call:
+            entries = [PromoEntry.deserialize(result)
+                       for result in _promo_query(label, min_score, size).get()]
+            call.reads = len(entries)
+
+    if len(entries) < size:
+        collection = firestore_client.collection('promos')
+        query = collection.where('label', '==', label).where('score', '>=', min_score)
+        query = query.order_by('score', direction=firestore.Query.DESCENDING).limit(size)
+        with track('firestore', 'query') as call:
+            legacy_entries = [PromoEntry.deserialize(result) for result in query.get()]
+            call.reads = len(legacy_entries)
+        entry_ids = {entry.id for entry in entries}
+        entries += [entry for entry in legacy_entries if entry.id not in entry_ids]
+        entries = entries[:size]
+
+    products = get_products([entry.id for entry in entries])
+    promos = [product for product in products if product]
+    promo_feed.set((label, min_score, size), promos)
+    return promos
+
+
+def _update_promo_feed(product):
+    """
+    Replaces the snapshot of a product in the promotion feeds that include it.
+    """
+    for key in promo_feed.keys():
+        promos = promo_feed.get(key)
+        if promos and any(promo.id == product.id for promo in promos):
+            promos = [product if promo.id == product.id else promo for promo in promos]
+            promo_feed.set(key, promos)
+
+
+def get_promos(label=PROMO_LABEL, min_score=PROMO_MIN_SCORE, size=PROMO_SIZE):
+    """
+    Helper function for getting promoted products. Promotions are served from
+    an in-memory feed, which is rebuilt when the results of its query change.
 
     Parameters:
-       None.
+       label (str): A label predicted by the AutoML model.
+       min_score (float): The minimum score of the label.
+       size (int): The maximum number of products to return.
 
     Output:
        A list of Product objects.
     """
 
-    promos = []
-    query = firestore_client.collection('promos').where('label', '==', 'pets').where('score', '>=', 0.7)
-    query = query.order_by('score', direction=firestore.Query.DESCENDING).limit(3)
-    query_results = query.get()
-    for result in query_results:
-        entry = PromoEntry.deserialize(result)
-        product = get_product(entry.id)
-        promos.append(product)
+    key = (label, min_score, size)
+    promos = promo_feed.get(key)
+    if promos is not None:
+        return promos
+
+    promos = _build_promo_feed(label, min_score, size)
+    _watch_promo_feed(key)
     return promos
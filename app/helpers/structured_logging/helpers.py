@@ -0,0 +1,39 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+A helper function for writing structured log entries.
+"""
+
+
+import json
+
+
+def log(message, severity='INFO', **fields):
+    """
+    Writes a structured log entry to stdout, where App Engine picks it up as
+    a JSON payload.
+
+    Parameters:
+       message (str): The message of the log entry.
+       severity (str): The severity of the log entry, e.g. 'WARNING'.
+       **fields: Additional fields of the log entry.
+
+    Output:
+       None.
+    """
+    entry = {'severity': severity, 'message': message}
+    entry.update(fields)
+    print(json.dumps(entry), flush=True)
@@ -18,36 +18,104 @@ This module is the main flask application.
 """
 
 
-import firebase_admin
-from flask import Flask
+import os
+import time
+
+# Set IMPORT_TIME_REPORT to 1 to log how long each module takes to import,
+# and how long it takes to serve the first request.
+IMPORT_TIME_REPORT = os.environ.get('IMPORT_TIME_REPORT') == '1'
+# Set LAZY_IMPORTS to 1 to import the payment and sell paths on the first
+# request to them instead of at startup.
+LAZY_IMPORTS = os.environ.get('LAZY_IMPORTS') == '1'
+# Set TRACING to 0 to disable tracing. OpenCensus is slow to import, so in
+# lazy mode tracing is disabled unless TRACING is set to 1.
+TRACING = os.environ.get('TRACING', '0' if LAZY_IMPORTS else '1') == '1'
+# Set CLOUD_DEBUGGER to 0 to disable Cloud Debugger. It is slow to enable,
+# so in lazy mode it is disabled unless CLOUD_DEBUGGER is set to 1.
+CLOUD_DEBUGGER = os.environ.get('CLOUD_DEBUGGER', '0' if LAZY_IMPORTS else '1') == '1'
 
-from blueprints import *
+started_at = time.monotonic()
+if IMPORT_TIME_REPORT:
+    from startup import import_profiler
+    from helpers import structured_logging
+    import_profiler.start()
 
+from flask import Flask
 
-# Initialize Firebase Admin SDK.
-# See https://firebase.google.com/docs/admin/setup for more information.
-firebase = firebase_admin.initialize_app()
+# Google Cloud clients, including the Firebase Admin SDK app, are created on
+# first use. See helpers/clients for more information.
 
 
 # Enable Google Cloud Debugger
 # See https://cloud.google.com/debugger/docs/setup/python for more information.
-try:
-    import googleclouddebugger
-    googleclouddebugger.enable()
-except ImportError:
-    pass
+if CLOUD_DEBUGGER:
+    try:
+        import googleclouddebugger
+        googleclouddebugger.enable()
+    except ImportError:
+        pass
 
 
 app = Flask(__name__)
 app.secret_key = b'A Super Secret Key'
 
+# Log the backend calls made by each request; see middlewares/request_metrics
+# for more information.
+from middlewares import request_metrics
+request_metrics.init_app(app)
+
+# Trace a sample of requests; see middlewares/tracing for more information.
+if TRACING:
+    from middlewares import tracing
+    tracing.init_app(app)
+
+# Build product image URLs and srcsets in templates; see
+# templates/parts/product_image.html.
+from helpers import product_catalog
+app.add_template_global(product_catalog.image_url)
+app.add_template_global(product_catalog.image_srcset)
+app.add_template_global(product_catalog.image_formats)
+
+
+if LAZY_IMPORTS:
+    from blueprints.cart import cart_page
+    from blueprints.checkout import checkout_page
+    from blueprints.product_catalog import product_catalog_page
+    from blueprints.signin import signin_page
+    from startup.lazy_views import register_lazy_routes
+
+    app.register_blueprint(cart_page)
+    app.register_blueprint(checkout_page)
+    app.register_blueprint(product_catalog_page)
+    app.register_blueprint(signin_page)
+    register_lazy_routes(app)
+else:
+    from blueprints import *
+
+    app.register_blueprint(cart_page)
+    app.register_blueprint(charge_page)
+    app.register_blueprint(checkout_page)
+    app.register_blueprint(product_catalog_page)
+    app.register_blueprint(sell_page)
+    app.register_blueprint(signin_page)
+
+
+if IMPORT_TIME_REPORT:
+    structured_logging.log('import_time_report',
+                           startup_ms=round((time.monotonic() - started_at) * 1000, 2),
+                           lazy_imports=LAZY_IMPORTS,
+                           **import_profiler.stop())
+
+    first_request_logged = False
 
-app.register_blueprint(cart_page)
-app.register_blueprint(charge_page)
-app.register_blueprint(checkout_page)
-app.register_blueprint(product_catalog_page)
-app.register_blueprint(sell_page)
-app.register_blueprint(signin_page)
+    @app.after_request
+    def log_first_request(response):
+        global first_request_logged
+        if not first_request_logged:
+            first_request_logged = True
+            structured_logging.log('first_request_served',
+                                   time_to_first_request_ms=round((time.monotonic() - started_at) * 1000, 2))
+        return response
 
 
 if __name__ == '__main__':
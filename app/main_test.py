@@ -57,6 +57,14 @@ def test_product_catalog(client):
     assert 'Serverless Store' in str(r.data)
 
 
+def test_product_catalog_invalid_cursor(client):
+    """
+    Should reject malformed pagination cursors.
+    """
+    r = client.get('/?cursor=not-a-cursor')
+    assert r.status_code == 400
+
+
 def test_cart(client):
     """
     Should display the cart page.
@@ -99,3 +107,202 @@ def test_signin(client):
     """
     r = client.get('/signin')
     assert r.status_code == 200
+
+
+@pytest.fixture
+def session_auth(monkeypatch):
+    """
+    Gets the auth middleware with a session key set.
+    """
+    import middlewares.auth
+    monkeypatch.setattr(middlewares.auth, 'AUTH_SESSION_KEY', 'k' * 32)
+    return middlewares.auth
+
+
+SESSION_AUTH_CONTEXT = {
+    'uid': 'uid',
+    'username': 'user',
+    'email': 'user@example.com'
+}
+
+
+def test_session_cookie(session_auth):
+    """
+    Should accept a session cookie with the ID token it was minted for.
+    """
+    cookie = session_auth.mint_session_cookie(SESSION_AUTH_CONTEXT, 'token')
+    assert session_auth.verify_session_cookie(cookie, 'token') == SESSION_AUTH_CONTEXT
+
+
+def test_session_cookie_tampered_signature(session_auth, monkeypatch):
+    """
+    Should reject session cookies with a tampered signature, or signed with
+    another key.
+    """
+    payload, signature = session_auth.mint_session_cookie(SESSION_AUTH_CONTEXT, 'token').split('.')
+    assert session_auth.verify_session_cookie(f'{payload}.{signature[::-1]}', 'token') == {}
+
+    monkeypatch.setattr(session_auth, 'AUTH_SESSION_KEY', 'A Super Secret Key')
+    forged = session_auth.mint_session_cookie(dict(SESSION_AUTH_CONTEXT, uid='victim'), 'token')
+    monkeypatch.setattr(session_auth, 'AUTH_SESSION_KEY', 'k' * 32)
+    assert session_auth.verify_session_cookie(forged, 'token') == {}
+
+
+def test_session_cookie_expired(session_auth, monkeypatch):
+    """
+    Should reject expired session cookies.
+    """
+    monkeypatch.setattr(session_auth, 'AUTH_SESSION_TTL', -1)
+    cookie = session_auth.mint_session_cookie(SESSION_AUTH_CONTEXT, 'token')
+    assert session_auth.verify_session_cookie(cookie, 'token') == {}
+
+
+def test_session_cookie_token_mismatch(session_auth):
+    """
+    Should reject session cookies sent with another ID token.
+    """
+    cookie = session_auth.mint_session_cookie(SESSION_AUTH_CONTEXT, 'token')
+    assert session_auth.verify_session_cookie(cookie, 'another-token') == {}
+
+
+def test_session_key_required(session_auth):
+    """
+    Should refuse to sign session cookies with a short or public key.
+    """
+    for key in ['', 'A Super Secret Key']:
+        with pytest.raises(RuntimeError):
+            session_auth.check_session_key(key)
+    session_auth.check_session_key('k' * 32)
+
+
+# Modules shared with Cloud Functions, by path, and the functions holding a
+# copy of them. Each function is deployed from its own directory.
+SHARED_MODULES = {
+    'helpers/eventing/envelope.py': ['automl', 'detect_labels', 'pay_with_stripe'],
+    'helpers/instrumentation/trace_transport.py': ['pay_with_stripe'],
+    'helpers/carts/cart_removal.py': ['pay_with_stripe'],
+    'helpers/orders/order_status.py': ['pay_with_stripe'],
+}
+
+
+def test_shared_module_copies():
+    """
+    Should keep the copies of shared modules in Cloud Functions identical to
+    the modules of the app.
+    """
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    for path, functions in SHARED_MODULES.items():
+        with open(os.path.join(app_dir, path), 'rb') as f:
+            module = f.read()
+        for function in functions:
+            copy_path = os.path.join(app_dir, '..', 'functions', function, os.path.basename(path))
+            with open(copy_path, 'rb') as f:
+                assert f.read() == module, f'{copy_path} differs from {path}'
+
+
+@pytest.fixture
+def fake_firestore(monkeypatch):
+    """
+    Gets an in-memory fake of Firestore, shared with the benchmark (see
+    extras/benchmark), in place of the Firestore client.
+    """
+    benchmark_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '..', 'extras', 'benchmark')
+    monkeypatch.syspath_prepend(benchmark_dir)
+    import fakes
+    from google.cloud import firestore
+    from helpers import clients, product_catalog
+
+    monkeypatch.setattr(firestore, 'transactional', fakes.transactional)
+    factory = clients.helpers._factories['firestore']
+    clients.register_factory('firestore', fakes.FakeFirestoreClient)
+    product_catalog.product_cache.clear()
+    yield clients.get_client('firestore')
+    product_catalog.product_cache.clear()
+    clients.register_factory('firestore', factory)
+
+
+def test_add_to_cart_migrates_per_line_cart(fake_firestore, monkeypatch):
+    """
+    Should keep the per-line cart of a user when adding an item to it after
+    switching to per-user carts.
+    """
+    from helpers import carts
+    for product_id in ['p1', 'p2', 'p3']:
+        fake_firestore.collection('products').document(product_id).set({
+            'name': product_id,
+            'description': '',
+            'image': product_id,
+            'labels': [],
+            'price': 1,
+            'created_at': 0
+        })
+    for i, product_id in enumerate(['p1', 'p2']):
+        fake_firestore.collection('carts').document().set({
+            'uid': 'uid',
+            'item_id': product_id,
+            'modify_time': i
+        })
+
+    monkeypatch.setattr(carts.helpers, 'CART_STORAGE_MODE', 'per_user')
+    carts.add_to_cart('uid', 'p3')
+
+    assert [item.item_id for item in carts.get_cart('uid')] == ['p3', 'p2', 'p1']
+    assert list(fake_firestore.collection('carts').get()) == []
+
+
+def test_remove_items_splits_batches(fake_firestore):
+    """
+    Should remove the checked-out items of a per-line cart in batched writes
+    of at most 500 operations, and keep the other items.
+    """
+    from helpers import carts
+    item_ids = [f'p{i}' for i in range(501)]
+    for item_id in item_ids + ['kept']:
+        fake_firestore.collection('carts').document().set({
+            'uid': 'uid',
+            'item_id': item_id,
+            'modify_time': 0
+        })
+
+    assert carts.remove_items(fake_firestore, 'uid', item_ids, per_user=False) == (502, 501)
+    assert fake_firestore.calls['firestore.commit'] == 2
+    assert [item.get('item_id') for item in fake_firestore.collection('carts').get()] == ['kept']
+
+
+def test_promo_feed_follows_its_query(fake_firestore, monkeypatch):
+    """
+    Should watch the query of a promotion feed once, and rebuild the feed
+    from its snapshots.
+    """
+    import fakes
+    from helpers import product_catalog
+    callbacks = []
+    monkeypatch.setattr(fakes.FakeQuery, 'on_snapshot',
+                        lambda query, callback: callbacks.append(callback) or fakes.FakeWatch())
+    monkeypatch.setattr(product_catalog.helpers, '_watches', {})
+    product_catalog.promo_feed.clear()
+    for product_id, score in [('p1', 0.9), ('p2', 0.8)]:
+        fake_firestore.collection('products').document(product_id).set({
+            'name': product_id,
+            'description': '',
+            'image': product_id,
+            'labels': ['pets'],
+            'price': 1,
+            'created_at': 0
+        })
+    fake_firestore.collection('promos').document('p1').set({
+        'label': 'pets',
+        'score': 0.9,
+        'scores': {'pets': 0.9}
+    })
+
+    assert [product.id for product in product_catalog.get_promos('pets', 0.7, 1)] == ['p1']
+    assert [product.id for product in product_catalog.get_promos('pets', 0.7, 1)] == ['p1']
+    assert len(callbacks) == 1
+
+    promo = fake_firestore.collection('promos').document('p2')
+    promo.set({'label': 'pets', 'score': 0.95, 'scores': {'pets': 0.95}})
+    callbacks[0]([promo.get()], [], None)
+    assert [product.id for product in product_catalog.get_promos('pets', 0.7, 1)] == ['p2']
+    product_catalog.promo_feed.clear()
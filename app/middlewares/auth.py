@@ -18,17 +18,121 @@ This module includes decorators for authenticating requests.
 """
 
 
+import base64
+import binascii
 from functools import wraps
-from flask import redirect, request, url_for
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
 
+from flask import make_response, redirect, request, url_for
+
+import firebase_admin
 from firebase_admin import auth
 
+from helpers import clients
+from helpers.caching import LRUCache
+
+AUTH_TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 4096))
+# How often to refresh the public certs used to verify ID tokens, in seconds.
+AUTH_CERT_REFRESH_INTERVAL = float(os.environ.get('AUTH_CERT_REFRESH_INTERVAL', 1800))
+# Set AUTH_SESSION_COOKIE to 1 to issue a signed session cookie after
+# verifying an ID token; requests with a valid session cookie skip ID token
+# verification until the session expires.
+AUTH_SESSION_COOKIE = os.environ.get('AUTH_SESSION_COOKIE') == '1'
+AUTH_SESSION_TTL = int(os.environ.get('AUTH_SESSION_TTL', 300))
+# The key session cookies are signed with. Anyone who knows it can mint a
+# session for any user, so it must be a secret of its own: not the secret
+# key of the app, which is checked into source control.
+AUTH_SESSION_KEY = os.environ.get('AUTH_SESSION_KEY', '')
+AUTH_SESSION_KEY_MIN_LENGTH = 32
+SESSION_COOKIE_NAME = 'store_session'
+ID_TOKEN_CERT_URI = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+
+# Authentication contexts of verified ID tokens, keyed by token hash. Each
+# entry expires with its token.
+token_cache = LRUCache(max_size=AUTH_TOKEN_CACHE_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+def check_session_key(key):
+    """
+    Raises RuntimeError if a key is unfit for signing session cookies.
+    """
+    if len(key) < AUTH_SESSION_KEY_MIN_LENGTH:
+        raise RuntimeError('AUTH_SESSION_COOKIE requires AUTH_SESSION_KEY to be set to a '
+                           f'secret of at least {AUTH_SESSION_KEY_MIN_LENGTH} characters')
+
+
+if AUTH_SESSION_COOKIE:
+    check_session_key(AUTH_SESSION_KEY)
+
+_cert_refresher = None
+_cert_refresher_lock = threading.Lock()
+
+
+def _cert_request(app):
+    """
+    Gets the HTTP request object the Firebase Admin SDK fetches public certs
+    with. The SDK caches the certs in it, so fetching them through it keeps
+    the cache of the SDK warm. Returns None if the SDK does not expose it.
+
+    The SDK does not expose the request object publicly; this relies on its
+    internals, as of the version pinned in requirements.txt. Check it when
+    upgrading firebase-admin.
+    """
+    try:
+        # firebase-admin 4.0 and later
+        return auth._get_client(app)._token_verifier.request
+    except AttributeError:
+        pass
+    try:
+        # firebase-admin 2.x and 3.x
+        return auth._get_auth_service(app).token_verifier.request
+    except AttributeError:
+        return None
+
+
+def _refresh_certs():
+    """
+    Fetches the public certs for verifying ID tokens in the background, so
+    that requests do not wait for them to be (re)fetched.
+    """
+    while True:
+        try:
+            cert_request = _cert_request(clients.get_client('firebase'))
+            if cert_request is None:
+                logger.warning('Cannot prefetch the public certs for ID tokens with '
+                               'firebase-admin %s; they are fetched on demand instead',
+                               firebase_admin.__version__)
+                return
+            cert_request(ID_TOKEN_CERT_URI, method='GET')
+        except Exception:
+            logger.exception('Failed to refresh the public certs for ID tokens')
+        time.sleep(AUTH_CERT_REFRESH_INTERVAL)
+
+
+def _start_cert_refresher():
+    global _cert_refresher
+    if _cert_refresher:
+        return
+
+    with _cert_refresher_lock:
+        if not _cert_refresher:
+            _cert_refresher = threading.Thread(target=_refresh_certs, daemon=True)
+            _cert_refresher.start()
+
 
 def verify_firebase_id_token(token):
     """
     A helper function for verifying ID tokens issued by Firebase.
     See https://firebase.google.com/docs/auth/admin/verify-id-tokens for
-    more information.
+    more information. Verified tokens are cached until they expire.
 
     Parameters:
        token (str): A token issued by Firebase.
@@ -36,8 +140,15 @@ def verify_firebase_id_token(token):
     Output:
        auth_context (dict): Authentication context.
     """
+    key = hashlib.sha256(token.encode()).hexdigest()
+    auth_context = token_cache.get(key)
+    if auth_context is not None:
+        return dict(auth_context)
+
+    _start_cert_refresher()
     try:
-        full_auth_context = auth.verify_id_token(token)
+        full_auth_context = auth.verify_id_token(token,
+                                                 app=clients.get_client('firebase'))
     except ValueError:
         return {}
 
@@ -46,7 +157,110 @@ def verify_firebase_id_token(token):
         'uid': full_auth_context.get('uid'),
         'email': full_auth_context.get('email')
     }
-    return auth_context
+    token_cache.set(key, auth_context, ttl=full_auth_context.get('exp', 0) - time.time())
+    return dict(auth_context)
+
+
+def _sign(payload):
+    return hmac.new(AUTH_SESSION_KEY.encode(), payload, hashlib.sha256).digest()
+
+
+def _token_fingerprint(token):
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+def mint_session_cookie(auth_context, token):
+    """
+    A helper function for minting a session cookie after an ID token has
+    been verified. The cookie holds the authentication context, an expiration
+    time and a fingerprint of the ID token, signed with AUTH_SESSION_KEY.
+
+    Parameters:
+       auth_context (dict): Authentication context.
+       token (str): The verified ID token.
+
+    Output:
+       The value of the session cookie (str).
+    """
+    session = {
+        'uid': auth_context.get('uid'),
+        'email': auth_context.get('email'),
+        'username': auth_context.get('username'),
+        'exp': int(time.time() + AUTH_SESSION_TTL),
+        'tok': _token_fingerprint(token)
+    }
+    payload = base64.urlsafe_b64encode(json.dumps(session).encode())
+    signature = base64.urlsafe_b64encode(_sign(payload))
+    return f'{payload.decode()}.{signature.decode()}'
+
+
+def verify_session_cookie(cookie, token):
+    """
+    A helper function for verifying a session cookie minted by
+    mint_session_cookie.
+
+    Parameters:
+       cookie (str): The value of the session cookie.
+       token (str): The ID token sent along with the session cookie. The
+                    session is only valid for the token it was minted for.
+
+    Output:
+       auth_context (dict): Authentication context; empty if the cookie is
+                            invalid or expired.
+    """
+    try:
+        payload, signature = cookie.encode().split(b'.')
+        if not hmac.compare_digest(base64.urlsafe_b64decode(signature), _sign(payload)):
+            return {}
+        session = json.loads(base64.urlsafe_b64decode(payload))
+    except (AttributeError, TypeError, ValueError, binascii.Error):
+        return {}
+
+    if session.get('exp', 0) <= time.time() or \
+       session.get('tok') != _token_fingerprint(token):
+        return {}
+
+    return {
+        'username': session.get('username'),
+        'uid': session.get('uid'),
+        'email': session.get('email')
+    }
+
+
+def _authenticate():
+    """
+    Authenticates the current request.
+
+    Output:
+       A tuple of the authentication context (empty if not signed in) and
+       the value of a new session cookie to set, if any.
+    """
+    firebase_id_token = request.cookies.get('firebase_id_token')
+    if not firebase_id_token:
+        return {}, None
+
+    if AUTH_SESSION_COOKIE:
+        auth_context = verify_session_cookie(request.cookies.get(SESSION_COOKIE_NAME),
+                                             firebase_id_token)
+        if auth_context:
+            return auth_context, None
+
+    auth_context = verify_firebase_id_token(firebase_id_token)
+    if auth_context and AUTH_SESSION_COOKIE:
+        return auth_context, mint_session_cookie(auth_context, firebase_id_token)
+    return auth_context, None
+
+
+def _set_session_cookie(response, session_cookie):
+    if not session_cookie:
+        return response
+
+    response = make_response(response)
+    response.set_cookie(SESSION_COOKIE_NAME, session_cookie,
+                        max_age=AUTH_SESSION_TTL,
+                        secure=request.is_secure,
+                        httponly=True)
+    return response
 
 
 def auth_required(f):
@@ -63,15 +277,12 @@ def auth_required(f):
     """
     @wraps(f)
     def decorated(*args, **kwargs):
-        firebase_id_token = request.cookies.get('firebase_id_token')
-        if not firebase_id_token:
-            return redirect(url_for('product_catalog_page.display'))
-
-        auth_context = verify_firebase_id_token(firebase_id_token)
+        auth_context, session_cookie = _authenticate()
         if not auth_context:
             return redirect(url_for('product_catalog_page.display'))
 
-        return f(auth_context=auth_context, *args, **kwargs)
+        response = f(auth_context=auth_context, *args, **kwargs)
+        return _set_session_cookie(response, session_cookie)
     return decorated
 
 def auth_optional(f):
@@ -88,13 +299,10 @@ def auth_optional(f):
     """
     @wraps(f)
     def decorated(*args, **kwargs):
-        firebase_id_token = request.cookies.get('firebase_id_token')
-        if not firebase_id_token:
-            return f(auth_context=None, *args, **kwargs)
-
-        auth_context = verify_firebase_id_token(firebase_id_token)
+        auth_context, session_cookie = _authenticate()
         if not auth_context:
             return f(auth_context=None, *args, **kwargs)
 
-        return f(auth_context=auth_context, *args, **kwargs)
+        response = f(auth_context=auth_context, *args, **kwargs)
+        return _set_session_cookie(response, session_cookie)
     return decorated
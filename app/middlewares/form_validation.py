@@ -21,7 +21,7 @@
 from functools import wraps
 
 from flask_wtf import FlaskForm
-from wtforms import FieldList, FloatField, StringField
+from wtforms import BooleanField, FieldList, FloatField, StringField
 from wtforms.validators import DataRequired, Optional
 
 
@@ -48,6 +48,7 @@ class CheckOutForm(FlaskForm):
     email = StringField('email', validators=[DataRequired()])
     mobile = StringField('mobile', validators=[DataRequired()])
     stripeToken = StringField('stripeToken', validators=[DataRequired()])
+    from_cart = BooleanField('from_cart')
 
 
 def sell_form_validation_required(f):
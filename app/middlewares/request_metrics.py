@@ -0,0 +1,103 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This module reports the backend calls made while serving each request, as
+accounted by helpers/instrumentation.
+
+Every request is logged as a structured log entry with the number of calls,
+reads, writes and the time spent per backend. Requests over the read or
+latency budget are logged with severity WARNING. In debug mode (or with
+REQUEST_METRICS_HEADERS set to 1) the numbers are also returned as response
+headers.
+"""
+
+
+import os
+
+from flask import current_app, g, request
+
+from helpers import instrumentation, structured_logging
+
+# Requests reading more documents than REQUEST_READ_BUDGET, or taking longer
+# than REQUEST_LATENCY_BUDGET_MS milliseconds, are flagged as over budget.
+REQUEST_READ_BUDGET = int(os.environ.get('REQUEST_READ_BUDGET', 100))
+REQUEST_LATENCY_BUDGET_MS = float(os.environ.get('REQUEST_LATENCY_BUDGET_MS', 500))
+REQUEST_METRICS_HEADERS = os.environ.get('REQUEST_METRICS_HEADERS') == '1'
+
+
+def _start_request():
+    g.request_stats, g.request_stats_token = instrumentation.start_request()
+
+
+def _report_request(response):
+    stats = g.get('request_stats')
+    if stats is None:
+        return response
+
+    latency_ms = round(stats.elapsed_ms(), 2)
+    reads = stats.total('reads')
+    backends = stats.backends()
+    over_budget = []
+    if reads > REQUEST_READ_BUDGET:
+        over_budget.append('reads')
+    if latency_ms > REQUEST_LATENCY_BUDGET_MS:
+        over_budget.append('latency')
+
+    structured_logging.log('slow_request' if over_budget else 'request',
+                           severity='WARNING' if over_budget else 'INFO',
+                           method=request.method,
+                           path=request.path,
+                           endpoint=request.endpoint,
+                           status=response.status_code,
+                           latency_ms=latency_ms,
+                           reads=reads,
+                           writes=stats.total('writes'),
+                           backends=backends,
+                           over_budget=over_budget)
+
+    if REQUEST_METRICS_HEADERS or current_app.debug:
+        # See https://www.w3.org/TR/server-timing/ for the format of the
+        # Server-Timing header, which browser developer tools display.
+        timings = [f'{backend};dur={stats["time_ms"]}' for backend, stats in backends.items()]
+        timings.append(f'total;dur={latency_ms}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+        for backend, stats in backends.items():
+            response.headers[f'X-Backend-{backend.capitalize()}'] = \
+                'calls={calls}, reads={reads}, writes={writes}, time_ms={time_ms}'.format(**stats)
+        if over_budget:
+            response.headers['X-Over-Budget'] = ', '.join(over_budget)
+    return response
+
+
+def _end_request(exception=None):
+    token = g.pop('request_stats_token', None)
+    if token is not None:
+        instrumentation.end_request(token)
+
+
+def init_app(app):
+    """
+    Registers the request metrics hooks with a Flask app.
+
+    Parameters:
+       app (Flask): The Flask app.
+
+    Output:
+       None.
+    """
+    app.before_request(_start_request)
+    app.after_request(_report_request)
+    app.teardown_request(_end_request)
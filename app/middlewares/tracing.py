@@ -0,0 +1,82 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This module traces requests with OpenCensus and exports the traces to
+Stackdriver Tracing. See https://opencensus.io/ for more information.
+
+A sample of requests is traced, as are requests whose trace context (the
+X-Cloud-Trace-Context header) asks for tracing. Backend calls made through
+the helpers (see helpers/instrumentation) and template rendering are traced
+as child spans of the request span. Spans are exported in the background;
+see helpers/clients for the exporter.
+"""
+
+
+import os
+
+import jinja2
+from opencensus.trace import execution_context
+from opencensus.trace.ext.flask.flask_middleware import FlaskMiddleware
+from opencensus.trace.samplers import probability
+from opencensus.trace.tracers import noop_tracer
+
+from helpers import clients, instrumentation
+
+# The fraction of requests to trace, between 0 and 1.
+TRACE_SAMPLING_RATE = float(os.environ.get('TRACE_SAMPLING_RATE', 0.1))
+# Requests to URLs matching these paths are not traced.
+TRACE_BLACKLIST_PATHS = ['static']
+
+
+class TracedTemplate(jinja2.Template):
+    """
+    A Jinja template which traces its rendering as a span.
+    """
+
+    def render(self, *args, **kwargs):
+        with instrumentation.span(f'render_template:{self.name}'):
+            return super().render(*args, **kwargs)
+
+
+def _clear_tracer(exception=None):
+    # The tracer of a request stays in a thread local after the request;
+    # clear it so that backend calls made later on the same thread, outside
+    # of a request, are not added to a finished trace.
+    execution_context.set_opencensus_tracer(noop_tracer.NoopTracer())
+    execution_context.set_current_span(None)
+
+
+def init_app(app):
+    """
+    Enables tracing in a Flask app.
+
+    Parameters:
+       app (Flask): The Flask app.
+
+    Output:
+       None.
+    """
+    # Teardown functions run in the reverse order of registration, i.e. this
+    # one after the one of the OpenCensus middleware.
+    app.teardown_request(_clear_tracer)
+    # The exporter is created on first export, so that enabling tracing
+    # does not connect to Stackdriver at startup.
+    FlaskMiddleware(app,
+                    blacklist_paths=TRACE_BLACKLIST_PATHS,
+                    sampler=probability.ProbabilitySampler(rate=TRACE_SAMPLING_RATE),
+                    exporter=clients.LazyClient('trace_exporter'))
+    app.jinja_env.template_class = TracedTemplate
+    instrumentation.enable_tracing()
@@ -0,0 +1,148 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This module measures how long it takes to import each module, similar to
+python -X importtime. See helpers/structured_logging for reporting the
+results as a structured log entry.
+"""
+
+
+import sys
+import threading
+import time
+
+
+class ImportProfiler:
+    """
+    A meta path finder which times the execution of every module imported
+    while it is installed. It finds modules with the other finders on
+    sys.meta_path and only wraps the loading step.
+    """
+
+    def __init__(self):
+        self.cumulative = {}
+        self.children = {}
+        self._local = threading.local()
+
+    def find_spec(self, fullname, path=None, target=None):
+        spec = None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        if spec is None:
+            return None
+
+        loader = spec.loader
+        # Loaders shared by many modules (e.g. the importers of built-in
+        # modules) are classes and are left alone.
+        if loader is None or isinstance(loader, type) or not hasattr(loader, 'exec_module'):
+            return spec
+
+        exec_module = loader.exec_module
+
+        def timed_exec_module(module):
+            stack = self._stack()
+            stack.append(fullname)
+            started_at = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                elapsed = time.perf_counter() - started_at
+                stack.pop()
+                self.cumulative[fullname] = elapsed
+                if stack:
+                    parent = stack[-1]
+                    self.children[parent] = self.children.get(parent, 0) + elapsed
+
+        loader.exec_module = timed_exec_module
+        return spec
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def report(self, top=25):
+        """
+        Summarizes the import times.
+
+        Parameters:
+           top (int): The number of slowest modules to include.
+
+        Output:
+           A dict with the total import time and the slowest modules, in
+           milliseconds. Self time excludes the time spent importing other
+           modules.
+        """
+        modules = []
+        for name, cumulative in self.cumulative.items():
+            modules.append({
+                'module': name,
+                'self_ms': round((cumulative - self.children.get(name, 0)) * 1000, 2),
+                'cumulative_ms': round(cumulative * 1000, 2)
+            })
+        modules.sort(key=lambda module: module['self_ms'], reverse=True)
+        total = sum(module['self_ms'] for module in modules)
+        return {
+            'module_count': len(modules),
+            'total_ms': round(total, 2),
+            'slowest_modules': modules[:top]
+        }
+
+
+_profiler = None
+
+
+def start():
+    """
+    Starts timing imports.
+
+    Parameters:
+       None.
+
+    Output:
+       None.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = ImportProfiler()
+        sys.meta_path.insert(0, _profiler)
+
+
+def stop():
+    """
+    Stops timing imports.
+
+    Parameters:
+       None.
+
+    Output:
+       The report of the import times (see ImportProfiler.report), or None
+       if the profiler was not started.
+    """
+    global _profiler
+    if _profiler is None:
+        return None
+
+    if _profiler in sys.meta_path:
+        sys.meta_path.remove(_profiler)
+    report = _profiler.report()
+    _profiler = None
+    return report
+
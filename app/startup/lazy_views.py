@@ -0,0 +1,81 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This module registers routes whose view functions are imported on the first
+request to them. See http://flask.pocoo.org/docs/1.0/patterns/lazyloading/
+for more information.
+"""
+
+
+import importlib
+import threading
+import time
+
+from helpers import structured_logging
+
+
+# Routes of the payment and sell paths, which import form validation and
+# eventing. Endpoints match the ones of the blueprints so that url_for keeps
+# working.
+LAZY_ROUTES = [
+    ('/charge', 'charge_page.process', 'blueprints.charge.blueprint', 'process', ['POST']),
+    ('/sell', 'sell_page.display', 'blueprints.sell.blueprint', 'display', ['GET']),
+    ('/sell', 'sell_page.process', 'blueprints.sell.blueprint', 'process', ['POST']),
+]
+
+
+class LazyView:
+    """
+    A view function which imports the actual view function on first call.
+    """
+
+    def __init__(self, module_name, function_name):
+        self.module_name = module_name
+        self.function_name = function_name
+        self._view = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._view is None:
+                started_at = time.perf_counter()
+                module = importlib.import_module(self.module_name)
+                structured_logging.log('lazy_view_loaded',
+                                       module=self.module_name,
+                                       duration_ms=round((time.perf_counter() - started_at) * 1000, 2))
+                self._view = getattr(module, self.function_name)
+        return self._view
+
+    def __call__(self, *args, **kwargs):
+        view = self._view or self._load()
+        return view(*args, **kwargs)
+
+
+def register_lazy_routes(app):
+    """
+    Registers the routes in LAZY_ROUTES with lazily imported view functions.
+
+    Parameters:
+       app (Flask): The Flask app.
+
+    Output:
+       None.
+    """
+    for rule, endpoint, module_name, function_name, methods in LAZY_ROUTES:
+        app.add_url_rule(rule,
+                         endpoint=endpoint,
+                         view_func=LazyView(module_name, function_name),
+                         methods=methods)
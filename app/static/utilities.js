@@ -127,3 +127,21 @@ function submitSellForm() {
   document.getElementById('price').value = price;
   document.getElementById('sell-form').submit();
 };
+
+function showFallbackImage(image, originalURL, placeholderURL) {
+    if (image.dataset.fallback) {
+        // The original image failed to load too.
+        image.onerror = null;
+        image.src = placeholderURL;
+        return;
+    }
+    // Drop the derivatives, e.g. of images not backfilled yet, so that the
+    // browser loads the original image.
+    image.dataset.fallback = `original`;
+    image.parentNode.querySelectorAll(`source`).forEach(function(source) {
+        source.remove();
+    });
+    image.removeAttribute(`srcset`);
+    image.removeAttribute(`sizes`);
+    image.src = originalURL;
+}
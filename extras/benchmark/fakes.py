@@ -0,0 +1,456 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+In-memory stand-ins for the Firestore client, the Pub/Sub publisher, the
+trace exporter and the Stripe API, implementing the subset of the client
+APIs the app and the Cloud Functions use. Every call that would be a round
+trip to the backend is counted in calls, keyed by '<backend>.<operation>'.
+"""
+
+
+from collections import Counter
+from concurrent.futures import Future
+import copy
+import functools
+import threading
+import time
+import types
+import uuid
+
+from google.cloud.firestore import DELETE_FIELD
+
+DESCENDING = 'DESCENDING'
+
+
+def _get_field(data, field_path):
+    for key in field_path.split('.'):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a
+}
+
+
+class FakeDocumentSnapshot:
+
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = copy.deepcopy(data)
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path):
+        return _get_field(self._data, field_path)
+
+
+class FakeDocumentReference:
+
+    def __init__(self, client, collection_name, document_id):
+        self._client = client
+        self._collection_name = collection_name
+        self.id = document_id
+
+    def _documents(self):
+        return self._client._collections.setdefault(self._collection_name, {})
+
+    def get(self, field_paths=None, transaction=None):
+        self._client._count('firestore.get')
+        with self._client._lock:
+            return FakeDocumentSnapshot(self, self._documents().get(self.id))
+
+    def set(self, document_data, merge=False):
+        self._client._count('firestore.write')
+        self._set(document_data, merge)
+
+    def update(self, field_updates):
+        self._client._count('firestore.write')
+        self._update(field_updates)
+
+    def delete(self):
+        self._client._count('firestore.write')
+        self._delete()
+
+    def _set(self, document_data, merge=False):
+        with self._client._lock:
+            documents = self._documents()
+            if merge and self.id in documents:
+                documents[self.id].update(copy.deepcopy(document_data))
+            else:
+                documents[self.id] = copy.deepcopy(document_data)
+
+    def _update(self, field_updates):
+        with self._client._lock:
+            data = self._documents()[self.id]
+            for field_path, value in field_updates.items():
+                keys = field_path.split('.')
+                target = data
+                for key in keys[:-1]:
+                    target = target.setdefault(key, {})
+                if value is DELETE_FIELD:
+                    target.pop(keys[-1], None)
+                else:
+                    target[keys[-1]] = copy.deepcopy(value)
+
+    def _delete(self):
+        with self._client._lock:
+            self._documents().pop(self.id, None)
+
+
+class FakeQuery:
+
+    def __init__(self, client, collection_name, filters=(), orders=(),
+                 limit=None, start_after=None):
+        self._client = client
+        self._collection_name = collection_name
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        fields = {
+            'filters': self._filters,
+            'orders': self._orders,
+            'limit': self._limit,
+            'start_after': self._start_after
+        }
+        fields.update(changes)
+        return FakeQuery(self._client, self._collection_name, **fields)
+
+    def where(self, field_path, op_string, value):
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields):
+        return self._copy(start_after=document_fields)
+
+    def select(self, field_paths):
+        return self
+
+    def _sort_key(self, document_id, data, field_path):
+        if field_path == '__name__':
+            return document_id
+        return _get_field(data, field_path)
+
+    def get(self, transaction=None):
+        self._client._count('firestore.query')
+        with self._client._lock:
+            documents = list(self._client._collections.get(self._collection_name, {}).items())
+
+        results = []
+        for document_id, data in documents:
+            if all(_OPERATORS[op](_get_field(data, field_path), value)
+                   for field_path, op, value in self._filters):
+                results.append((document_id, data))
+
+        for field_path, direction in reversed(self._orders):
+            results.sort(key=lambda result: self._sort_key(result[0], result[1], field_path),
+                         reverse=direction == DESCENDING)
+
+        if self._start_after:
+            def cursor_value(field_path):
+                value = self._start_after.get(field_path)
+                return getattr(value, 'id', value)
+            cursor = [cursor_value(field_path) for field_path, _ in self._orders]
+            results = [
+                result for result in results
+                if [self._sort_key(result[0], result[1], field_path)
+                    for field_path, _ in self._orders] > cursor
+            ]
+
+        if self._limit is not None:
+            results = results[:self._limit]
+
+        for document_id, data in results:
+            reference = FakeDocumentReference(self._client, self._collection_name, document_id)
+            yield FakeDocumentSnapshot(reference, data)
+
+    stream = get
+
+    def on_snapshot(self, callback):
+        # Snapshots are never delivered; measure PRODUCT_CACHE_WATCH and
+        # PROMO_FEED_WATCH against the emulator instead.
+        return FakeWatch()
+
+
+class FakeCollectionReference(FakeQuery):
+
+    def __init__(self, client, collection_name):
+        super().__init__(client, collection_name)
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._client, self._collection_name,
+                                     document_id or uuid.uuid4().hex)
+
+
+class FakeWatch:
+
+    def unsubscribe(self):
+        pass
+
+
+class FakeWriteBatch:
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(functools.partial(reference._set, document_data, merge))
+
+    def update(self, reference, field_updates):
+        self._writes.append(functools.partial(reference._update, field_updates))
+
+    def delete(self, reference):
+        self._writes.append(reference._delete)
+
+    def commit(self):
+        self._client._count('firestore.commit')
+        for write in self._writes:
+            write()
+        self._writes = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    A transaction whose writes are applied on commit.
+    """
+
+
+def transactional(to_wrap):
+    """
+    A stand-in for google.cloud.firestore.transactional which runs the
+    function once and commits its writes. Transactions are isolated by
+    running them one at a time.
+    """
+    @functools.wraps(to_wrap)
+    def wrapper(transaction, *args, **kwargs):
+        with transaction._client._lock:
+            result = to_wrap(transaction, *args, **kwargs)
+            transaction.commit()
+        return result
+    return wrapper
+
+
+class FakeFirestoreClient:
+
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.RLock()
+        self.calls = Counter()
+        self._calls_lock = threading.Lock()
+
+    def _count(self, operation):
+        with self._calls_lock:
+            self.calls[operation] += 1
+
+    def collection(self, collection_name):
+        return FakeCollectionReference(self, collection_name)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        self._count('firestore.get_all')
+        with self._lock:
+            snapshots = [
+                FakeDocumentSnapshot(reference, reference._documents().get(reference.id))
+                for reference in references
+            ]
+        return iter(snapshots)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+
+class FakePublisherClient:
+
+    def __init__(self):
+        self.calls = Counter()
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def topic_path(self, project, topic):
+        return f'projects/{project}/topics/{topic}'
+
+    def publish(self, topic, data, **attributes):
+        with self._lock:
+            self.calls['pubsub.publish'] += 1
+            self.messages.append((topic, data, attributes))
+        future = Future()
+        future.set_result(str(len(self.messages)))
+        return future
+
+
+class FakeTraceExporter:
+
+    def __init__(self, transport=None):
+        self.transport = transport(self) if transport else None
+
+    def export(self, span_datas):
+        if self.transport:
+            self.transport.export(span_datas)
+
+    def emit(self, span_datas, event=None):
+        pass
+
+
+class FakeStripeError(Exception):
+    pass
+
+
+class FakeStripe:
+    """
+    A stand-in for the stripe module. Charges succeed after latency seconds,
+    except with the test token tok_chargeDeclined. Like the Stripe API, a
+    request with the idempotency key of a previous request returns the same
+    charge, or raises the same error, instead of charging again.
+    """
+
+    def __init__(self, latency=0.0):
+        self.api_key = None
+        self.latency = latency
+        self.calls = Counter()
+        self.charges = {}
+        self.declines = set()
+        self.error = types.SimpleNamespace(StripeError=FakeStripeError,
+                                           CardError=FakeStripeError)
+        self.Charge = types.SimpleNamespace(create=self._create_charge)
+        self._lock = threading.Lock()
+
+    def _create_charge(self, amount, currency, source, description=None,
+                       idempotency_key=None):
+        time.sleep(self.latency)
+        with self._lock:
+            if idempotency_key and idempotency_key in self.charges:
+                self.calls['stripe.idempotent_replay'] += 1
+                return self.charges[idempotency_key]
+            if idempotency_key and idempotency_key in self.declines:
+                self.calls['stripe.idempotent_replay'] += 1
+                raise FakeStripeError('Your card was declined.')
+
+            self.calls['stripe.charge'] += 1
+            if source == 'tok_chargeDeclined':
+                if idempotency_key:
+                    self.declines.add(idempotency_key)
+                raise FakeStripeError('Your card was declined.')
+            charge = {
+                'id': f'ch_{uuid.uuid4().hex}',
+                'amount': amount,
+                'currency': currency,
+                'description': description
+            }
+            self.charges[idempotency_key or charge['id']] = charge
+            return charge
+
+
+class FakeVisionClient:
+    """
+    A stand-in for the Cloud Vision ImageAnnotatorClient. Each request takes
+    latency seconds, plus latency_per_image seconds per image.
+    """
+
+    LABELS = ['Dog', 'Cat', 'Shoe', 'Bag', 'Furniture', 'Toy', 'Plant', 'Lamp']
+
+    def __init__(self, latency=0.1, latency_per_image=0.01):
+        self.latency = latency
+        self.latency_per_image = latency_per_image
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _annotate(self, image_uri):
+        offset = sum(image_uri.encode()) % len(self.LABELS)
+        labels = self.LABELS[offset:] + self.LABELS[:offset]
+        return types.SimpleNamespace(
+            error=types.SimpleNamespace(code=0, message=''),
+            label_annotations=[types.SimpleNamespace(description=label) for label in labels])
+
+    def label_detection(self, image):
+        with self._lock:
+            self.calls['vision.label_detection'] += 1
+        time.sleep(self.latency + self.latency_per_image)
+        return self._annotate(image.source.image_uri)
+
+    def batch_annotate_images(self, requests):
+        with self._lock:
+            self.calls['vision.batch_annotate_images'] += 1
+        time.sleep(self.latency + self.latency_per_image * len(requests))
+        return types.SimpleNamespace(responses=[
+            self._annotate(request['image']['source']['image_uri'])
+            for request in requests
+        ])
+
+
+class FakeImage:
+
+    def __init__(self):
+        self.source = types.SimpleNamespace(image_uri=None)
+
+
+# A stand-in for the google.cloud.vision module.
+fake_vision = types.SimpleNamespace(
+    ImageAnnotatorClient=FakeVisionClient,
+    types=types.SimpleNamespace(Image=FakeImage),
+    enums=types.SimpleNamespace(
+        Feature=types.SimpleNamespace(Type=types.SimpleNamespace(LABEL_DETECTION=1)))
+)
+
+
+class FakeSubscriberClient:
+    """
+    A stand-in for the Pub/Sub SubscriberClient, serving synchronous pulls
+    from a list of messages with data and attributes.
+    """
+
+    def __init__(self, messages=()):
+        self.calls = Counter()
+        self._messages = list(messages)
+        self._lock = threading.Lock()
+
+    def subscription_path(self, project, subscription):
+        return f'projects/{project}/subscriptions/{subscription}'
+
+    def pull(self, subscription, max_messages, return_immediately=False):
+        with self._lock:
+            self.calls['pubsub.pull'] += 1
+            messages = self._messages[:max_messages]
+            self._messages = self._messages[max_messages:]
+        return types.SimpleNamespace(received_messages=[
+            types.SimpleNamespace(ack_id=str(i),
+                                  message=types.SimpleNamespace(data=data, attributes=attributes))
+            for i, (data, attributes) in enumerate(messages)
+        ])
+
+    def acknowledge(self, subscription, ack_ids):
+        with self._lock:
+            self.calls['pubsub.acknowledge'] += 1
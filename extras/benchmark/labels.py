@@ -0,0 +1,153 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Local throughput test for Cloud Function detect_labels.
+
+Labels a backlog of new products twice against in-memory fakes of Firestore
+and Cloud Vision: once with one detect_labels invocation per event, as with
+the Pub/Sub trigger, and once with the batch worker (see
+functions/detect_labels/batch.py). See README.md for more information.
+"""
+
+
+import argparse
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import time
+
+import fakes
+
+FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', '..', 'functions', 'detect_labels')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=500,
+                        help='number of new products to label')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='number of concurrent invocations of detect_labels')
+    parser.add_argument('--vision-latency', type=float, default=0.1,
+                        help='latency of a Cloud Vision request in seconds')
+    parser.add_argument('--vision-latency-per-image', type=float, default=0.01,
+                        help='additional latency per image in seconds')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    return parser.parse_args()
+
+
+def load_function(args):
+    """
+    Imports the function with fake clients in place of the Google Cloud
+    clients.
+    """
+    from google.cloud import firestore
+
+    firestore.Client = fakes.FakeFirestoreClient
+    fakes.fake_vision.ImageAnnotatorClient = lambda: fakes.FakeVisionClient(
+        latency=args.vision_latency, latency_per_image=args.vision_latency_per_image)
+    sys.modules['google.cloud.vision'] = fakes.fake_vision
+
+    sys.path.insert(0, os.path.abspath(FUNCTION_DIR))
+    import main
+    return main
+
+
+def seed(function, args):
+    """
+    Creates products without labels and the label_detection events for them.
+
+    Output:
+       A list of (data, attributes) tuples, one per product.
+    """
+    function.firestore_client._collections.clear()
+    events = []
+    for i in range(args.products):
+        product_id = f'product-{i}'
+        function.firestore_client.collection('products').document(product_id).set({
+            'name': f'Product {i}',
+            'image': f'image-{i}',
+            'labels': []
+        })
+        events.append(function.envelope.encode('label_detection', {
+            'product_id': product_id,
+            'product_image': f'image-{i}'
+        }, function.envelope.JSON))
+    return events
+
+
+def measure(function, mode, run):
+    function.firestore_client.calls.clear()
+    function.vision_client.calls.clear()
+    started_at = time.perf_counter()
+    invocations = run()
+    elapsed = time.perf_counter() - started_at
+
+    labeled = sum(1 for document in function.firestore_client.collection('products').get()
+                  if document.get('labels'))
+    calls = dict(function.firestore_client.calls)
+    calls.update(function.vision_client.calls)
+    calls.pop('firestore.query')
+    return {
+        'mode': mode,
+        'products_labeled': labeled,
+        'invocations': invocations,
+        'elapsed_s': round(elapsed, 2),
+        'products_per_s': round(labeled / elapsed, 1),
+        'backend_calls': dict(sorted(calls.items()))
+    }
+
+
+def main():
+    args = parse_args()
+    function = load_function(args)
+
+    events = seed(function, args)
+
+    def run_single():
+        messages = [{'data': base64.b64encode(data).decode(), 'attributes': attributes}
+                    for data, attributes in events]
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(lambda message: function.detect_labels(message, None), messages))
+        return len(messages)
+
+    single = measure(function, 'per event', run_single)
+
+    events = seed(function, args)
+
+    def run_batch():
+        function.subscriber = fakes.FakeSubscriberClient(events)
+        function.detect_labels_batch(None)
+        return 1
+
+    batched = measure(function, 'batch', run_batch)
+
+    results = [single, batched]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        for key, value in result.items():
+            print(f'{key:<18} {value}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Local load test for Cloud Function pay_with_stripe.
+
+The function runs in-process against in-memory fakes of Firestore, Pub/Sub
+and Stripe. Each order_created event is delivered several times, in random
+order and concurrently, as Pub/Sub may redeliver events; the test reports
+how many Stripe charges were made and whether any order was charged twice.
+See README.md for more information.
+"""
+
+
+import argparse
+import base64
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+import random
+import sys
+import time
+import types
+
+import fakes
+
+FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', '..', 'functions', 'pay_with_stripe')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=200,
+                        help='number of orders to pay')
+    parser.add_argument('--deliveries', type=int, default=3,
+                        help='number of times each event is delivered')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='number of concurrent invocations')
+    parser.add_argument('--stripe-latency', type=float, default=0.05,
+                        help='latency of the fake Stripe API in seconds')
+    parser.add_argument('--decline-rate', type=float, default=0.05,
+                        help='fraction of payments made with a declined card')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+    return parser.parse_args()
+
+
+def load_function(args):
+    """
+    Imports the function with fake clients in place of the Google Cloud
+    clients and the Stripe library.
+    """
+    from google.cloud import firestore, pubsub_v1
+
+    firestore.Client = fakes.FakeFirestoreClient
+    firestore.transactional = fakes.transactional
+    pubsub_v1.PublisherClient = fakes.FakePublisherClient
+    sys.modules['opencensus.trace.exporters.stackdriver_exporter'] = types.SimpleNamespace(
+        StackdriverExporter=fakes.FakeTraceExporter)
+    sys.modules['stripe'] = fakes.FakeStripe(latency=args.stripe_latency)
+
+    sys.path.insert(0, os.path.abspath(FUNCTION_DIR))
+    import main
+    return main
+
+
+def seed(function, args):
+    """
+    Creates orders checked out from carts, the carts and the payment events
+    for them.
+
+    Output:
+       A list of Pub/Sub messages, one per order.
+    """
+    messages = []
+    for i in range(args.orders):
+        order_id = f'order-{i}'
+        function.firestore_client.collection('orders').document(order_id).set({
+            'amount': round(random.uniform(1, 500), 2),
+            'shipping': {'email': f'user-{i}@example.com'},
+            'status': 'order_created',
+            'items': [f'product-{i}'],
+            'cart_uid': f'user-{i}'
+        })
+        function.firestore_client.collection('carts').document(f'cart-{i}').set({
+            'uid': f'user-{i}',
+            'item_id': f'product-{i}',
+            'modify_time': 0
+        })
+        token = 'tok_chargeDeclined' if random.random() < args.decline_rate else 'tok_visa'
+        data, attributes = function.envelope.encode('order_created', {
+            'order_id': order_id,
+            'token': token,
+            'trace_id': None
+        }, function.envelope.JSON)
+        messages.append({
+            'data': base64.b64encode(data).decode(),
+            'attributes': attributes
+        })
+    return messages
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    function = load_function(args)
+    messages = seed(function, args)
+
+    deliveries = messages * args.deliveries
+    random.shuffle(deliveries)
+
+    def deliver(message):
+        started_at = time.perf_counter()
+        function.pay_with_stripe(message, None)
+        return time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(deliver, deliveries))
+    elapsed = time.perf_counter() - started_at
+
+    stripe = function.stripe
+    statuses = Counter(
+        document.get('status')
+        for document in function.firestore_client.collection('orders').get()
+    )
+    published = Counter(function.envelope.decode(data, attributes).get('event_type')
+                        for _, data, attributes in function.publisher.messages)
+    calls = dict(function.firestore_client.calls)
+    calls.update(stripe.calls)
+    result = {
+        'orders': args.orders,
+        'deliveries': len(deliveries),
+        'throughput_per_s': round(len(deliveries) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'stripe_charges': stripe.calls['stripe.charge'],
+        'duplicate_charges': stripe.calls['stripe.charge'] - len(stripe.charges) -
+                             statuses.get('payment_failed', 0),
+        'order_statuses': dict(statuses),
+        'events_published': dict(published),
+        # Only the carts of failed payments should keep their items.
+        'cart_items_left': len(list(function.firestore_client.collection('carts').get())),
+        'backend_calls': dict(sorted(calls.items()))
+    }
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    for key, value in result.items():
+        print(f'{key:<22} {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Local load test and benchmark for the Serverless Store app.
+
+The app runs in-process against in-memory fakes of Firestore and Pub/Sub
+(or against the Firestore emulator with --emulator), is seeded with
+products and carts, and is driven by concurrent workers. See README.md for
+more information.
+"""
+
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+import fakes
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'app')
+
+ENDPOINTS = ['/', '/cart', '/checkout', '/charge']
+
+CHARGE_FORM = {
+    'address_1': '1600 Amphitheatre Pkwy',
+    'address_2': '',
+    'city': 'Mountain View',
+    'state': 'CA',
+    'zip_code': '94043',
+    'email': 'user@example.com',
+    'mobile': '555-0100',
+    'stripeToken': 'tok_visa'
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=300,
+                        help='number of products to seed')
+    parser.add_argument('--carts', type=int, default=50,
+                        help='number of users with a cart to seed')
+    parser.add_argument('--items-per-cart', type=int, default=10,
+                        help='number of items in each cart')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='number of requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of concurrent workers')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                        help='comma-separated endpoints to drive, in order')
+    parser.add_argument('--emulator', action='store_true',
+                        help='use the Firestore emulator at FIRESTORE_EMULATOR_HOST '
+                             'instead of the in-memory fake')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+    return parser.parse_args()
+
+
+def create_app(args):
+    """
+    Imports the app with fake backends registered in place of the Google
+    Cloud clients, and authentication reduced to trusting the ID token
+    cookie as the user ID.
+    """
+    sys.path.insert(0, os.path.abspath(APP_DIR))
+    from helpers import clients
+
+    backends = {}
+    if not args.emulator:
+        from google.cloud import firestore
+        firestore.transactional = fakes.transactional
+        backends['firestore'] = fakes.FakeFirestoreClient()
+        clients.register_factory('firestore', lambda: backends['firestore'])
+    if not os.environ.get('PUBSUB_EMULATOR_HOST'):
+        backends['publisher'] = fakes.FakePublisherClient()
+        clients.register_factory('publisher', lambda: backends['publisher'])
+    clients.register_factory('trace_exporter', fakes.FakeTraceExporter)
+
+    import middlewares.auth
+    middlewares.auth.verify_firebase_id_token = lambda token: {
+        'uid': token,
+        'username': token,
+        'email': f'{token}@example.com'
+    }
+
+    # Per-request log entries would drown the report.
+    from helpers import structured_logging
+    structured_logging.log = lambda message, **fields: None
+
+    import main
+    main.app.testing = True
+    main.app.config['WTF_CSRF_ENABLED'] = False
+    return main.app, backends
+
+
+def seed(args):
+    """
+    Seeds products, promotions and carts through the app's helpers.
+
+    Output:
+       A dict of item IDs in cart, by user ID.
+    """
+    from helpers import carts, clients, product_catalog
+
+    product_ids = []
+    for i in range(args.products):
+        product = product_catalog.Product(name=f'Product {i}',
+                                          description=f'Description of product {i}',
+                                          image=f'image-{i}',
+                                          labels=['pets'] if i % 10 == 0 else [],
+                                          price=round(random.uniform(1, 100), 2),
+                                          created_at=int(time.time()) - args.products + i)
+        product_ids.append(product_catalog.add_product(product))
+
+    for product_id in product_ids[::10]:
+        score = random.uniform(0.5, 1)
+        clients.firestore_client.collection('promos').document(product_id).set({
+            'label': 'pets',
+            'score': score,
+            'scores': {'pets': score, 'toys': 1 - score}
+        })
+
+    cart_contents = {}
+    for i in range(args.carts):
+        uid = f'user-{i}'
+        items = random.sample(product_ids, min(args.items_per_cart, len(product_ids)))
+        for item_id in items:
+            carts.add_to_cart(uid, item_id)
+        cart_contents[uid] = items
+    return cart_contents
+
+
+def backend_calls(backends):
+    calls = {}
+    for backend in backends.values():
+        calls.update(backend.calls)
+    return calls
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def set_cookie(client, key, value):
+    try:
+        # Flask 2.3 and later
+        client.set_cookie(key, value)
+    except TypeError:
+        client.set_cookie('localhost', key, value)
+
+
+def run_endpoint(app, endpoint, args, cart_contents):
+    """
+    Sends args.requests requests to an endpoint from args.concurrency
+    workers.
+
+    Output:
+       A list of (latency in seconds, status code) tuples.
+    """
+    local = threading.local()
+    uids = list(cart_contents)
+
+    def send(i):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        uid = uids[i % len(uids)]
+        set_cookie(local.client, 'firebase_id_token', uid)
+        started_at = time.perf_counter()
+        if endpoint == '/charge':
+            form = dict(CHARGE_FORM)
+            if cart_contents[uid]:
+                form['from_cart'] = 'y'
+            for j, item_id in enumerate(cart_contents[uid] or [random.choice(uids)]):
+                form[f'product_ids-{j}'] = item_id
+            response = local.client.post('/charge', data=form)
+        elif endpoint == '/checkout':
+            response = local.client.get('/checkout?from_cart=1')
+        else:
+            response = local.client.get(endpoint)
+        return time.perf_counter() - started_at, response.status_code
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        return list(executor.map(send, range(args.requests)))
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    app, backends = create_app(args)
+    cart_contents = seed(args)
+
+    results = []
+    for endpoint in args.endpoints.split(','):
+        calls_before = backend_calls(backends)
+        started_at = time.perf_counter()
+        samples = run_endpoint(app, endpoint, args, cart_contents)
+        elapsed = time.perf_counter() - started_at
+        calls_after = backend_calls(backends)
+
+        latencies = [latency for latency, _ in samples]
+        results.append({
+            'endpoint': endpoint,
+            'requests': len(samples),
+            'errors': sum(1 for _, status in samples if status >= 400),
+            'throughput_rps': round(len(samples) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'backend_calls_per_request': {
+                operation: round((count - calls_before.get(operation, 0)) / len(samples), 2)
+                for operation, count in sorted(calls_after.items())
+                if count != calls_before.get(operation, 0)
+            }
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f'{"endpoint":<10} {"req":>5} {"err":>4} {"rps":>8} {"p50 ms":>8} '
+          f'{"p95 ms":>8} {"p99 ms":>8}  backend calls/request')
+    for result in results:
+        calls = ', '.join(f'{operation}={count}'
+                          for operation, count in result['backend_calls_per_request'].items())
+        print(f'{result["endpoint"]:<10} {result["requests"]:>5} {result["errors"]:>4} '
+              f'{result["throughput_rps"]:>8} {result["p50_ms"]:>8} {result["p95_ms"]:>8} '
+              f'{result["p99_ms"]:>8}  {calls or "-"}')
+
+
+if __name__ == '__main__':
+    main()
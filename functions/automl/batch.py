@@ -0,0 +1,234 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Batch scoring of products with the AutoML model.
+
+Each promos/{product_id} document holds the top AUTOML_TOP_K labels of the
+product and their scores (scores), the top label and its score (label and
+score), and the ID of the model that scored it (model_id).
+
+rescore scores, page by page, the products which have no promotion
+document or were scored by another model, with up to AUTOML_CONCURRENCY
+predictions in flight. Its progress is saved in automl_models/current, so
+that a scheduled job can resume it; see automl_rescore in main.py. Products
+which failed to score are retried on the next call. Once the catalog is
+scored by the current model, it is checked again every
+RESCORE_RESCAN_INTERVAL seconds for products left without a promotion,
+e.g. because scoring them on creation failed.
+"""
+
+
+from concurrent import futures
+import logging
+import os
+import time
+
+AUTOML_MODEL_ID = os.environ.get('AUTOML_MODEL_ID')
+AUTOML_PROJECT = os.environ.get('AUTOML_PROJECT')
+if not AUTOML_PROJECT:
+    AUTOML_PROJECT = os.environ.get('GCP_PROJECT')
+# The number of labels to keep per product.
+AUTOML_TOP_K = int(os.environ.get('AUTOML_TOP_K', 5))
+# The maximum number of predictions in flight.
+AUTOML_CONCURRENCY = int(os.environ.get('AUTOML_CONCURRENCY', 4))
+# The number of products to check, and score with one batched write, at a
+# time.
+RESCORE_PAGE_SIZE = min(int(os.environ.get('RESCORE_PAGE_SIZE', 100)), 500)
+# How long to keep scoring products, in seconds. Keep it below the timeout
+# of the function.
+RESCORE_TIME_BUDGET = float(os.environ.get('RESCORE_TIME_BUDGET', 45))
+# How often to check the whole catalog again once it is scored, in seconds.
+RESCORE_RESCAN_INTERVAL = float(os.environ.get('RESCORE_RESCAN_INTERVAL', 24 * 3600))
+# The maximum number of failed products kept for retrying; the others are
+# picked up by the next check of the catalog.
+RESCORE_MAX_FAILED = 1000
+
+MODEL_STATE_COLLECTION = 'automl_models'
+MODEL_STATE_DOCUMENT = 'current'
+
+logger = logging.getLogger(__name__)
+
+
+def model_name():
+    return f'projects/{AUTOML_PROJECT}/locations/us-central1/models/{AUTOML_MODEL_ID}'
+
+
+def predict_scores(predict_client, image_data):
+    """
+    Returns the scores of the top AUTOML_TOP_K labels of an image, by label.
+    """
+    payload = {
+        'image': {
+            'image_bytes': image_data
+        }
+    }
+    # By default, only labels scoring at least 0.5 are returned.
+    response = predict_client.predict(model_name(), payload, params={'score_threshold': '0'})
+    results = sorted(response.payload, key=lambda result: result.classification.score,
+                     reverse=True)
+    return {
+        result.display_name: result.classification.score
+        for result in results[:AUTOML_TOP_K]
+    }
+
+
+def promo_document(scores):
+    """
+    Builds the promotion document of a product from the scores of its
+    labels.
+    """
+    label = max(scores, key=scores.get) if scores else None
+    return {
+        'label': label,
+        'score': scores.get(label, 0),
+        'scores': scores,
+        'model_id': AUTOML_MODEL_ID,
+        'scored_at': int(time.time())
+    }
+
+
+def score_products(predict_client, firestore_client, load_image, products):
+    """
+    Scores products and writes their promotion documents with a single
+    batched write.
+
+    Parameters:
+       predict_client (PredictionServiceClient): The AutoML client.
+       firestore_client (Client): The Firestore client.
+       load_image (func): Called with the image of a product; returns the
+                          image data to predict on.
+       products (List[Tuple[str, str]]): The IDs and images of the products.
+
+    Output:
+       A tuple of the number of products scored and the IDs of the products
+       which failed to score.
+    """
+
+    def score(product):
+        product_id, product_image = product
+        try:
+            return product_id, predict_scores(predict_client, load_image(product_image))
+        except Exception:
+            logger.exception('Failed to score product %s', product_id)
+            return product_id, None
+
+    with futures.ThreadPoolExecutor(max_workers=AUTOML_CONCURRENCY) as executor:
+        results = list(executor.map(score, products))
+
+    batch = firestore_client.batch()
+    scored = 0
+    failed = []
+    for product_id, scores in results:
+        if scores is None:
+            failed.append(product_id)
+            continue
+        batch.set(firestore_client.collection('promos').document(product_id),
+                  promo_document(scores))
+        scored += 1
+    if scored:
+        batch.commit()
+    return scored, failed
+
+
+def _stale_products(firestore_client, documents):
+    """
+    Returns the IDs and images of the products which have no promotion
+    document or were scored by another model.
+    """
+    references = [firestore_client.collection('promos').document(document.id)
+                  for document in documents]
+    model_ids = {
+        promo.id: promo.get('model_id') if promo.exists else None
+        for promo in firestore_client.get_all(references, field_paths=['model_id'])
+    }
+    return [(document.id, document.get('image')) for document in documents
+            if model_ids.get(document.id) != AUTOML_MODEL_ID]
+
+
+def _failed_products(firestore_client, product_ids):
+    """
+    Returns the IDs and images of the products which failed to score, and
+    still exist.
+    """
+    references = [firestore_client.collection('products').document(product_id)
+                  for product_id in product_ids]
+    return [(document.id, document.get('image'))
+            for document in firestore_client.get_all(references, field_paths=['image'])
+            if document.exists]
+
+
+def rescore(predict_client, firestore_client, load_image, time_budget=RESCORE_TIME_BUDGET):
+    """
+    Retries the products which failed to score, then scores the products
+    which are not scored by the current model, resuming where the previous
+    call stopped, until all products are checked or the time budget is
+    spent.
+
+    Parameters:
+       predict_client (PredictionServiceClient): The AutoML client.
+       firestore_client (Client): The Firestore client.
+       load_image (func): Called with the image of a product; returns the
+                          image data to predict on.
+       time_budget (float): How long to keep scoring products, in seconds.
+
+    Output:
+       The number of products scored.
+    """
+
+    state_reference = firestore_client.collection(MODEL_STATE_COLLECTION).document(MODEL_STATE_DOCUMENT)
+    state = state_reference.get().to_dict() or {}
+    if state.get('model_id') != AUTOML_MODEL_ID:
+        # The model changed; score the catalog again from the start.
+        state = {'model_id': AUTOML_MODEL_ID, 'cursor': None, 'complete': False, 'failed': []}
+    rescan = state.get('complete') and \
+        time.time() - state.get('completed_at', 0) >= RESCORE_RESCAN_INTERVAL
+    if state.get('complete') and not state.get('failed') and not rescan:
+        return 0
+
+    deadline = time.monotonic() + time_budget
+    scored = 0
+    failed = []
+    if state.get('failed'):
+        products = _failed_products(firestore_client, state['failed'])
+        scored, failed = score_products(predict_client, firestore_client, load_image, products)
+        state['failed'] = failed
+        state_reference.set(state)
+    if rescan:
+        state['cursor'] = None
+        state['complete'] = False
+
+    collection = firestore_client.collection('products')
+    while not state['complete'] and time.monotonic() < deadline:
+        query = collection.select(['image']).order_by('__name__').limit(RESCORE_PAGE_SIZE)
+        if state.get('cursor'):
+            query = query.start_after({'__name__': collection.document(state['cursor'])})
+        documents = list(query.get())
+
+        stale = _stale_products(firestore_client, documents) if documents else []
+        page_scored, page_failed = score_products(predict_client, firestore_client, load_image, stale)
+        scored += page_scored
+        failed += page_failed
+
+        if documents:
+            state['cursor'] = documents[-1].id
+        state['complete'] = len(documents) < RESCORE_PAGE_SIZE
+        if state['complete']:
+            state['completed_at'] = time.time()
+        state['failed'] = failed[:RESCORE_MAX_FAILED]
+        state_reference.set(state)
+
+    logger.info('Scored %d products with model %s; %d failed', scored, AUTOML_MODEL_ID, len(failed))
+    return scored
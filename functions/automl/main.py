@@ -18,49 +18,61 @@ Cloud Function for performing AutoML Vision predictions.
 """
 
 
-import base64
-import json
 import os
 
+from google.api_core import exceptions
 from google.cloud import automl_v1beta1
 from google.cloud import firestore
 from google.cloud import storage
 
-AUTOML_MODEL_ID = os.environ.get('AUTOML_MODEL_ID')
-AUTOML_PROJECT = os.environ.get('AUTOML_PROJECT')
-if not AUTOML_PROJECT:
-    AUTOML_PROJECT = os.environ.get('GCP_PROJECT')
+import batch
+import envelope
+
 BUCKET = os.environ.get('GCS_BUCKET')
+# The input size of the model, in pixels. If set, predictions use the
+# thumbnail of this size saved by Cloud Function upload_image, when
+# available, instead of the 640x640 image.
+AUTOML_INPUT_SIZE = os.environ.get('AUTOML_INPUT_SIZE')
 
 automl_predict_client = automl_v1beta1.PredictionServiceClient()
 firestore_client = firestore.Client()
 storage_client = storage.Client()
+# Unlike get_bucket, bucket does not make an API request.
+bucket = storage_client.bucket(BUCKET)
+
+def load_image(product_image):
+    """
+    Downloads the image of a product, as normalized by Cloud Function
+    upload_image.
+    """
+    if AUTOML_INPUT_SIZE:
+        try:
+            return bucket.blob(f'{product_image}_{AUTOML_INPUT_SIZE}.png').download_as_string()
+        except exceptions.NotFound:
+            # Images uploaded before the thumbnail was introduced.
+            pass
+    return bucket.blob(f'{product_image}.png').download_as_string()
 
 def automl(data, context):
     if 'data' in data:
-        request_json = base64.b64decode(data.get('data')).decode()
-        request = json.loads(request_json)
+        request = envelope.decode_pubsub_message(data)
         product_id = request.get('event_context').get('product_id')
         product_image = request.get('event_context').get('product_image')
 
-        bucket = storage_client.get_bucket(BUCKET)
-        blob = bucket.blob(f'{product_image}.png')
-        image_data = blob.download_as_string()
+        image_data = load_image(product_image)
+        scores = batch.predict_scores(automl_predict_client, image_data)
 
-        model_name = f'projects/{AUTOML_PROJECT}/locations/us-central1/models/{AUTOML_MODEL_ID}'
-        payload = {
-            'image': {
-                'image_bytes': image_data
-            }
-        }
-        response = automl_predict_client.predict(model_name, payload)
-        top_result = response.payload[0]
-        label = top_result.display_name
-        score = top_result.classification.score
-
-        firestore_client.collection('promos').document(product_id).set({
-            'label': label,
-            'score': score
-        })
+        firestore_client.collection('promos').document(product_id).set(
+            batch.promo_document(scores))
 
     return ''
+
+def automl_rescore(request):
+    """
+    Scores the products not scored by the current model; see batch.py.
+    Deploy with an HTTP trigger and invoke it periodically, e.g. with Cloud
+    Scheduler. After the model changes, successive invocations score the
+    whole catalog again.
+    """
+    scored = batch.rescore(automl_predict_client, firestore_client, load_image)
+    return f'Scored {scored} products'
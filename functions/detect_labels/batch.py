@@ -0,0 +1,186 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Batch mode of Cloud Function detect_labels.
+
+Instead of one invocation per new product, the batch worker pulls
+label_detection events from a pull subscription on the new product topic,
+labels up to VISION_BATCH_SIZE images per Cloud Vision request, sending up
+to VISION_CONCURRENCY requests at a time, and writes the labels of each
+pull with a single Firestore batched write. Use it
+instead of the push-triggered detect_labels when products are listed in
+bulk; see detect_labels_batch in main.py. Run `python batch.py` to drain the
+subscription locally.
+"""
+
+
+from concurrent import futures
+import logging
+import os
+import time
+
+from google.api_core import exceptions
+from google.cloud import vision
+
+import envelope
+
+GCP_PROJECT = os.environ.get('GCP_PROJECT')
+GCS_BUCKET = os.environ.get('GCS_BUCKET')
+LABEL_DETECTION_SUBSCRIPTION = os.environ.get('LABEL_DETECTION_SUBSCRIPTION')
+# Cloud Vision accepts at most 16 images per batch request.
+VISION_BATCH_SIZE = min(int(os.environ.get('VISION_BATCH_SIZE', 16)), 16)
+# The maximum number of Cloud Vision requests in flight.
+VISION_CONCURRENCY = int(os.environ.get('VISION_CONCURRENCY', 8))
+# The maximum number of events pulled, and labeled with one batched write,
+# at a time. A batched write holds at most 500 operations.
+PULL_MAX_MESSAGES = min(int(os.environ.get('PULL_MAX_MESSAGES', 128)), 500)
+# How long to keep pulling events, in seconds. Keep it below the timeout of
+# the function.
+DRAIN_TIME_BUDGET = float(os.environ.get('DRAIN_TIME_BUDGET', 45))
+MAX_LABELS = 3
+
+logger = logging.getLogger(__name__)
+
+
+def image_uri(product_image):
+    """
+    Returns the Cloud Storage URI of the image of a product.
+    """
+    return 'gs://{}/{}.png'.format(GCS_BUCKET, product_image)
+
+
+def top_labels(label_annotations):
+    """
+    Returns the descriptions of the most likely labels of an image.
+    """
+    return [label.description for label in label_annotations[:MAX_LABELS]]
+
+
+def _label_request(product_image):
+    return {
+        'image': {'source': {'image_uri': image_uri(product_image)}},
+        'features': [{
+            'type': vision.enums.Feature.Type.LABEL_DETECTION,
+            'max_results': MAX_LABELS
+        }]
+    }
+
+
+def _write_labels(firestore_client, labels):
+    """
+    Updates the labels of products with a single batched write. If some
+    products no longer exist, the batch fails as a whole; the others are
+    then updated one by one.
+    """
+    batch = firestore_client.batch()
+    for product_id, product_labels in labels.items():
+        reference = firestore_client.collection('products').document(product_id)
+        batch.update(reference, {'labels': product_labels})
+    try:
+        batch.commit()
+        return
+    except exceptions.NotFound:
+        pass
+
+    for product_id, product_labels in labels.items():
+        reference = firestore_client.collection('products').document(product_id)
+        try:
+            reference.update({'labels': product_labels})
+        except exceptions.NotFound:
+            logger.warning('Product %s no longer exists', product_id)
+
+
+def label_events(vision_client, firestore_client, events):
+    """
+    Labels the images of new products.
+
+    Parameters:
+       vision_client (ImageAnnotatorClient): The Cloud Vision client.
+       firestore_client (Client): The Firestore client.
+       events (List[dict]): The contexts of label_detection events, with
+                            product_id and product_image.
+
+    Output:
+       The number of products labeled.
+    """
+
+    chunks = [events[start:start + VISION_BATCH_SIZE]
+              for start in range(0, len(events), VISION_BATCH_SIZE)]
+
+    def annotate(chunk):
+        return vision_client.batch_annotate_images(
+            requests=[_label_request(event.get('product_image')) for event in chunk])
+
+    labels = {}
+    with futures.ThreadPoolExecutor(max_workers=VISION_CONCURRENCY) as executor:
+        responses = list(executor.map(annotate, chunks))
+    for chunk, response in zip(chunks, responses):
+        for event, image_response in zip(chunk, response.responses):
+            if image_response.error.code:
+                # Failed images are not retried, as in detect_labels.
+                logger.error('Failed to label product %s: %s',
+                             event.get('product_id'), image_response.error.message)
+                continue
+            labels[event.get('product_id')] = top_labels(image_response.label_annotations)
+
+    if labels:
+        _write_labels(firestore_client, labels)
+    return len(labels)
+
+
+def drain(subscriber, vision_client, firestore_client, time_budget=DRAIN_TIME_BUDGET):
+    """
+    Pulls and labels label_detection events until the subscription is empty
+    or the time budget is spent. Events are acknowledged once their labels
+    are written.
+
+    Parameters:
+       subscriber (SubscriberClient): The Pub/Sub subscriber client.
+       vision_client (ImageAnnotatorClient): The Cloud Vision client.
+       firestore_client (Client): The Firestore client.
+       time_budget (float): How long to keep pulling events, in seconds.
+
+    Output:
+       The number of products labeled.
+    """
+
+    subscription_path = subscriber.subscription_path(GCP_PROJECT, LABEL_DETECTION_SUBSCRIPTION)
+    deadline = time.monotonic() + time_budget
+    labeled = 0
+    while time.monotonic() < deadline:
+        response = subscriber.pull(subscription=subscription_path,
+                                   max_messages=PULL_MAX_MESSAGES,
+                                   return_immediately=True)
+        if not response.received_messages:
+            break
+
+        events = []
+        for received_message in response.received_messages:
+            message = received_message.message
+            event = envelope.decode(message.data, dict(message.attributes))
+            if event.get('event_type') == 'label_detection':
+                events.append(event.get('event_context'))
+
+        labeled += label_events(vision_client, firestore_client, events)
+        subscriber.acknowledge(subscription=subscription_path,
+                               ack_ids=[received_message.ack_id
+                                        for received_message in response.received_messages])
+    return labeled
+
+
+if __name__ == '__main__':
+    import main
+    print(main.detect_labels_batch(None))
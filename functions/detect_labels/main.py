@@ -18,33 +18,46 @@ Cloud Function for performing Cloud Vision image labeling.
 """
 
 
-import base64
-import json
 import os
 
 from google.cloud import firestore
+from google.cloud import pubsub_v1
 from google.cloud import vision
 
+import batch
+import envelope
+
 vision_client = vision.ImageAnnotatorClient()
 firestore_client = firestore.Client()
+subscriber = None
 
 GCS_BUCKET = os.environ.get('GCS_BUCKET')
 
 def detect_labels(data, context):
     if 'data' in data:
-        request_json = base64.b64decode(data.get('data')).decode()
-        request = json.loads(request_json)
+        request = envelope.decode_pubsub_message(data)
         product_id = request.get('event_context').get('product_id')
         product_image = request.get('event_context').get('product_image')
 
         image = vision.types.Image()
-        image.source.image_uri = 'gs://{}/{}.png'.format(GCS_BUCKET, product_image)
+        image.source.image_uri = batch.image_uri(product_image)
         response = vision_client.label_detection(image=image)
-        labels = response.label_annotations
-        top_labels = [ label.description for label in labels[:3] ]
+        top_labels = batch.top_labels(response.label_annotations)
 
-        product_data = firestore_client.collection('products').document(product_id).get().to_dict()
-        product_data['labels'] = top_labels
-        firestore_client.collection('products').document(product_id).set(product_data)
+        # Update only the labels of the product, in a single write.
+        firestore_client.collection('products').document(product_id).update({
+            'labels': top_labels
+        })
     
-    return ''
\ No newline at end of file
+    return ''
+
+def detect_labels_batch(request):
+    """
+    Labels new products in batches; see batch.py. Deploy with an HTTP
+    trigger and invoke it periodically, e.g. with Cloud Scheduler.
+    """
+    global subscriber
+    if subscriber is None:
+        subscriber = pubsub_v1.SubscriberClient()
+    labeled = batch.drain(subscriber, vision_client, firestore_client)
+    return f'Labeled {labeled} products'
@@ -18,60 +18,162 @@ Cloud Function for processing Stripe payments.
 """
 
 
-import base64
-import json
+import functools
 import os
 import time
+import uuid
 
 from google.cloud import firestore
 from google.cloud import pubsub_v1
 from opencensus.trace.tracer import Tracer
 from opencensus.trace.exporters import stackdriver_exporter
-from opencensus.trace.exporters.transports.background_thread import BackgroundThreadTransport
 import stripe
 
+import cart_removal
+import envelope
+import order_status
+import trace_transport
+
 API_KEY = os.environ.get('STRIPE_API_KEY')
 GCP_PROJECT = os.environ.get('GCP_PROJECT')
 PUBSUB_TOPIC_PAYMENT_COMPLETION = os.environ.get('PUBSUB_TOPIC_PAYMENT_COMPLETION')
+# The encoding of payment completion events. Keep the default, json, while
+# Cloud Function sendOrderConfirmation subscribes to the topic.
+EVENT_ENCODING = os.environ.get('EVENT_ENCODING', envelope.JSON)
+# The maximum number of spans waiting to be exported, and how long to wait
+# for them to be exported at the end of each invocation, in seconds.
+TRACE_EXPORT_QUEUE_SIZE = int(os.environ.get('TRACE_EXPORT_QUEUE_SIZE', 1000))
+TRACE_FLUSH_TIMEOUT = float(os.environ.get('TRACE_FLUSH_TIMEOUT', 2))
+# How long an invocation holds the claim on an order, in seconds. If it fails
+# to record the outcome of the payment in time, e.g. because the instance
+# crashed, a redelivery of the event may claim the order again. Each claim
+# holds a token; the outcome is only recorded by the holder of the claim.
+PAYMENT_LEASE_SECONDS = float(os.environ.get('PAYMENT_LEASE_SECONDS', 120))
+# The cart storage mode of the app, 'per_line' or 'per_user'; see
+# app/helpers/carts for more information.
+CART_STORAGE_MODE = os.environ.get('CART_STORAGE_MODE', 'per_line')
 
-firestore = firestore.Client()
+firestore_client = firestore.Client()
 publisher = pubsub_v1.PublisherClient()
-sde = stackdriver_exporter.StackdriverExporter()
+# Spans are exported from a background thread. Cloud Functions may throttle
+# background threads once the function returns, so the spans of each
+# invocation are flushed before returning.
+sde = stackdriver_exporter.StackdriverExporter(
+    transport=functools.partial(trace_transport.BoundedBackgroundTransport,
+                                max_queue_size=TRACE_EXPORT_QUEUE_SIZE))
 stripe.api_key = API_KEY
 
 def pay_with_stripe(data, context):
+    try:
+        process_payment(data)
+    finally:
+        sde.transport.flush(TRACE_FLUSH_TIMEOUT)
+    return ''
+
+@firestore.transactional
+def claim_order(transaction, reference, claim_token):
+    """
+    Moves an order from order_created to payment_processing, so that
+    redeliveries of the same event do not process the payment again. The
+    claim is stored with the given token.
+
+    Returns the order data as read, or None if the order does not exist, is
+    already processed, or is claimed by another invocation.
+    """
+    now = time.time()
+
+    def claimable(order_data):
+        # A payment_processing order may only be claimed once its lease
+        # has expired.
+        return order_data.get('status') == order_status.ORDER_CREATED or \
+            order_data.get('payment_lease_expires_at', 0) < now
+
+    return order_status.transition(
+        transaction, reference, order_status.PAYMENT_PROCESSING,
+        fields={
+            'payment_lease_expires_at': now + PAYMENT_LEASE_SECONDS,
+            'payment_claim_token': claim_token
+        },
+        guard=claimable)
+
+@firestore.transactional
+def record_outcome(transaction, reference, claim_token, event_type):
+    """
+    Moves a claimed order to the status of the outcome of its payment, and
+    releases the claim, if the claim with the given token is still held,
+    i.e. its lease did not expire and another invocation did not claim the
+    order again.
+
+    Returns whether the outcome was recorded.
+    """
+
+    def holds_claim(order_data):
+        return order_data.get('payment_claim_token') == claim_token
+
+    return order_status.transition(
+        transaction, reference, event_type,
+        fields={
+            'payment_lease_expires_at': firestore.DELETE_FIELD,
+            'payment_claim_token': firestore.DELETE_FIELD
+        },
+        guard=holds_claim) is not None
+
+def process_payment(data):
     tracer = Tracer(exporter=sde)
 
     if 'data' in data:
-        payment_request_json = base64.b64decode(data.get('data')).decode()
-        payment_request = json.loads(payment_request_json)
+        payment_request = envelope.decode_pubsub_message(data)
         token = payment_request.get('event_context').get('token')
         order_id = payment_request.get('event_context').get('order_id')
         trace_id = payment_request.get('event_context').get('trace_id')
-        tracer.span_context.trace_id = trace_id
+        # Continue the trace of the request, if it was traced.
+        if trace_id:
+            tracer.span_context.trace_id = trace_id
 
         with tracer.span(name="process_payment"):
-            order_data = firestore.collection('orders').document(order_id).get().to_dict()
+            reference = firestore_client.collection('orders').document(order_id)
+            claim_token = uuid.uuid4().hex
+            with tracer.span(name="claim_order"):
+                order_data = claim_order(firestore_client.transaction(), reference, claim_token)
+            if order_data is None:
+                print(f'Skipped order {order_id}: already processed or in progress')
+                return
+
             amount = order_data.get('amount')
             email = order_data.get('shipping').get('email')
 
             try:
                 charge = stripe.Charge.create(
                     # For US Dollars, Stripe use Cent as the unit
-                    amount=int(amount * 100),
+                    amount=int(round(amount * 100)),
                     currency='usd',
                     description='Example charge',
-                    source=token
+                    source=token,
+                    # Stripe returns the result of the first request with
+                    # the same key instead of charging again, e.g. if a
+                    # previous invocation lost its claim after charging.
+                    idempotency_key=order_id
                 )
-                order_data['status'] = 'payment_processed'
-                event_type = 'payment_processed'
-                
+                event_type = order_status.PAYMENT_PROCESSED
+
             except stripe.error.StripeError as err:
                 print(err)
-                order_data['status'] = 'payment_failed'
-                event_type = 'payment_failed'
-            
-            firestore.collection('orders').document(order_id).set(order_data)
+                event_type = order_status.PAYMENT_FAILED
+
+            # Only the status changes, so update it (and release the claim)
+            # with a partial write rather than rewriting the order. If the
+            # claim was lost, its new holder records the outcome, publishes
+            # the event and clears the cart instead.
+            with tracer.span(name="record_outcome"):
+                recorded = record_outcome(firestore_client.transaction(), reference,
+                                          claim_token, event_type)
+            if not recorded:
+                print(f'Skipped order {order_id}: claim lost before recording the outcome')
+                return
+            order_data.pop('payment_lease_expires_at', None)
+            order_data.pop('payment_claim_token', None)
+            order_data['status'] = event_type
+
             stream_event(
                 topic_name=PUBSUB_TOPIC_PAYMENT_COMPLETION,
                 event_type=event_type,
@@ -82,14 +184,16 @@ def pay_with_stripe(data, context):
                 }
             )
 
-    return ''
+            # Cleared last, so that a failure leaves the items in the cart
+            # but still fails the invocation once the order is recorded.
+            cart_uid = order_data.get('cart_uid')
+            if cart_uid and event_type == order_status.PAYMENT_PROCESSED:
+                with tracer.span(name="clear_cart"):
+                    cart_removal.remove_items(firestore_client, cart_uid,
+                                              order_data.get('items', []),
+                                              CART_STORAGE_MODE == 'per_user')
 
 def stream_event(topic_name, event_type, event_context):
     topic_path = publisher.topic_path(GCP_PROJECT, topic_name)
-    request = {
-        'event_type': event_type,
-        'created_time': str(int(time.time())),
-        'event_context': event_context
-    }
-    data = json.dumps(request).encode()
-    publisher.publish(topic_path, data)
+    data, attributes = envelope.encode(event_type, event_context, EVENT_ENCODING)
+    publisher.publish(topic_path, data, **attributes)
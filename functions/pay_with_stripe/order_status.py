@@ -0,0 +1,131 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+The statuses of an order and the transitions allowed between them.
+
+An order is created as order_created. Cloud Function pay_with_stripe claims
+it (payment_processing), then records the outcome of the payment
+(payment_processed or payment_failed). A payment_processing order whose
+claim has expired may be claimed again.
+
+Statuses only change through the helpers of this module, which write the
+status field (and any extra fields) with a partial update instead of
+rewriting the whole order. Cloud Function pay_with_stripe holds a copy of
+this module; test test_shared_module_copies in app/main_test.py checks that
+it matches.
+"""
+
+
+ORDER_CREATED = 'order_created'
+PAYMENT_PROCESSING = 'payment_processing'
+PAYMENT_PROCESSED = 'payment_processed'
+PAYMENT_FAILED = 'payment_failed'
+
+TRANSITIONS = {
+    ORDER_CREATED: {PAYMENT_PROCESSING},
+    PAYMENT_PROCESSING: {PAYMENT_PROCESSING, PAYMENT_PROCESSED, PAYMENT_FAILED},
+    PAYMENT_PROCESSED: set(),
+    PAYMENT_FAILED: set()
+}
+
+
+class InvalidTransitionError(Exception):
+    """
+    Raised when an order cannot move from its status to another.
+    """
+
+    def __init__(self, from_status, to_status):
+        super().__init__(f'Cannot change order status from {from_status} to {to_status}')
+        self.from_status = from_status
+        self.to_status = to_status
+
+
+def can_transition(from_status, to_status):
+    """
+    Helper function for checking whether an order may move from a status to
+    another.
+
+    Parameters:
+       from_status (str): The current status of the order.
+       to_status (str): The new status.
+
+    Output:
+       True if the transition is allowed.
+    """
+
+    return to_status in TRANSITIONS.get(from_status, ())
+
+
+def set_status(reference, from_status, to_status, fields=None, transaction=None):
+    """
+    Helper function for changing the status of an order with a single
+    partial write, when its current status is known, e.g. because the caller
+    holds a claim on the order.
+
+    Parameters:
+       reference (DocumentReference): The order document.
+       from_status (str): The current status of the order.
+       to_status (str): The new status.
+       fields (dict): Optional. Other fields to update, by field path.
+       transaction (Transaction): Optional. Write as part of a transaction.
+
+    Output:
+       None. Raises InvalidTransitionError if the transition is not allowed.
+    """
+
+    if not can_transition(from_status, to_status):
+        raise InvalidTransitionError(from_status, to_status)
+
+    field_updates = dict(fields or {})
+    field_updates['status'] = to_status
+    if transaction:
+        transaction.update(reference, field_updates)
+    else:
+        reference.update(field_updates)
+
+
+def transition(transaction, reference, to_status, fields=None, guard=None):
+    """
+    Helper function for changing the status of an order in a transaction,
+    after reading its current status. Call from a function decorated with
+    google.cloud.firestore.transactional.
+
+    Parameters:
+       transaction (Transaction): The transaction.
+       reference (DocumentReference): The order document.
+       to_status (str): The new status.
+       fields (dict): Optional. Other fields to update, by field path.
+       guard (func): Optional. Called with the order data; the status is
+                     only changed if it returns True.
+
+    Output:
+       The order data as read, or None if the order does not exist, the
+       transition is not allowed, or the guard rejected it.
+    """
+
+    snapshot = reference.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+
+    order_data = snapshot.to_dict()
+    from_status = order_data.get('status')
+    if not can_transition(from_status, to_status):
+        return None
+    if guard and not guard(order_data):
+        return None
+
+    set_status(reference, from_status, to_status, fields=fields, transaction=transaction)
+    return order_data
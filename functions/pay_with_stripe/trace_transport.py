@@ -0,0 +1,172 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+An OpenCensus transport which exports spans in batches from a background
+thread, through a bounded queue.
+
+Unlike the BackgroundThreadTransport of OpenCensus, whose queue is
+unbounded, spans are dropped when the queue is full, so that a slow or
+unavailable tracing backend does not grow the memory of the instance.
+Spans exported, dropped and failed to export are counted in metrics.
+
+Cloud Function pay_with_stripe holds a copy of this module; test
+test_shared_module_copies in app/main_test.py checks that it matches.
+"""
+
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from opencensus.trace.exporters.transports import base
+
+DEFAULT_MAX_QUEUE_SIZE = 1000
+DEFAULT_MAX_BATCH_SIZE = 50
+# How long to wait for a batch to fill up before exporting it, in seconds.
+DEFAULT_WAIT_PERIOD = 1.0
+# How long to wait for queued spans to be exported on shutdown, in seconds.
+DEFAULT_GRACE_PERIOD = 5.0
+
+logger = logging.getLogger(__name__)
+
+# Wakes up the worker thread to export the spans it holds without waiting
+# for the batch to fill up.
+_FLUSH = object()
+
+
+class BoundedBackgroundTransport(base.Transport):
+    """
+    Exports spans with exporter.emit from a background thread. Pass the
+    class, or a functools.partial of it with different limits, as the
+    transport of an exporter.
+
+    Parameters:
+       exporter: The OpenCensus exporter.
+       max_queue_size (int): The maximum number of spans waiting to be
+                             exported; spans are dropped beyond it.
+       max_batch_size (int): The maximum number of spans exported at a time.
+       wait_period (float): How long to wait for a batch to fill up.
+       grace_period (float): How long to wait for queued spans on shutdown.
+    """
+
+    def __init__(self, exporter, max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 wait_period=DEFAULT_WAIT_PERIOD,
+                 grace_period=DEFAULT_GRACE_PERIOD):
+        self.exporter = exporter
+        self.max_batch_size = max_batch_size
+        self.wait_period = wait_period
+        self.metrics = {'exported': 0, 'dropped': 0, 'failed': 0}
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        # The number of spans queued or being exported.
+        self._pending = 0
+        self._pending_condition = threading.Condition()
+        self._dropped_since_log = 0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        atexit.register(self.flush, grace_period)
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='trace-export',
+                                                daemon=True)
+                self._thread.start()
+
+    def export(self, span_datas):
+        """
+        Queues spans for export. Never blocks; spans which do not fit in the
+        queue are dropped.
+        """
+        if self._thread is None:
+            self._start()
+
+        for span_data in span_datas:
+            with self._pending_condition:
+                try:
+                    self._queue.put_nowait(span_data)
+                    self._pending += 1
+                except queue.Full:
+                    self.metrics['dropped'] += 1
+                    self._dropped_since_log += 1
+
+    def _next_batch(self):
+        batch = []
+        item = self._queue.get()
+        deadline = time.monotonic() + self.wait_period
+        while item is not _FLUSH:
+            batch.append(item)
+            if len(batch) >= self.max_batch_size:
+                break
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self.exporter.emit(batch)
+                failed = False
+            except Exception:
+                failed = True
+                logger.exception('Failed to export %d spans', len(batch))
+
+            with self._pending_condition:
+                self.metrics['failed' if failed else 'exported'] += len(batch)
+                self._pending -= len(batch)
+                dropped, self._dropped_since_log = self._dropped_since_log, 0
+                self._pending_condition.notify_all()
+            if dropped:
+                logger.warning('Dropped %d spans: the export queue is full', dropped)
+
+    def flush(self, timeout=DEFAULT_GRACE_PERIOD):
+        """
+        Exports the queued spans now, and waits until they are exported.
+
+        Parameters:
+           timeout (float): The maximum time to wait, in seconds.
+
+        Output:
+           True if all queued spans were exported (or failed to export)
+           within the timeout.
+        """
+        if self._thread is None:
+            return True
+
+        try:
+            self._queue.put_nowait(_FLUSH)
+        except queue.Full:
+            # The worker exports full batches without waiting.
+            pass
+
+        deadline = time.monotonic() + timeout
+        with self._pending_condition:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error('%d spans were still queued after %.1f s',
+                                 self._pending, timeout)
+                    return False
+                self._pending_condition.wait(remaining)
+        return True
@@ -0,0 +1,109 @@
+# Copyright 2018 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Backfill of the derivatives of images.
+
+Saves the missing derivatives of the images in the bucket, e.g. of images
+uploaded before derivatives were introduced, or after IMAGE_SIZES or
+IMAGE_FORMATS change. Run `python backfill.py` with the environment of the
+function (GCS_BUCKET, IMAGE_SIZES, IMAGE_FORMATS, AUTOML_INPUT_SIZE), with an
+ImageMagick build which can encode IMAGE_FORMATS, before setting
+IMAGE_DERIVATIVES to 1 in the app.
+"""
+
+
+from concurrent import futures
+import logging
+import re
+
+from wand.image import Image
+
+import main
+
+# The names of images and of their derivatives; see main.py.
+IMAGE_PATTERN = re.compile(r'^([0-9a-f]+)\.png$')
+DERIVATIVE_PATTERN = re.compile(r'^([0-9a-f]+)_(\d+)\.(\w+)$')
+# The maximum number of images converted at a time.
+BACKFILL_CONCURRENCY = 8
+
+logger = logging.getLogger(__name__)
+
+
+def missing_derivatives(names):
+    """
+    Lists the missing derivatives of images.
+
+    Parameters:
+       names (Iterable[str]): The names of the objects in the bucket.
+
+    Output:
+       A dict of the sizes and formats of the missing derivatives, as sets
+       of (size, format) tuples, by image ID.
+    """
+    images = set()
+    saved = {}
+    for name in names:
+        match = IMAGE_PATTERN.match(name)
+        if match:
+            images.add(match.group(1))
+            continue
+        match = DERIVATIVE_PATTERN.match(name)
+        if match:
+            image_id, size, format = match.groups()
+            saved.setdefault(image_id, set()).add((int(size), format))
+
+    keys = main.derivative_keys()
+    missing = {image_id: keys - saved.get(image_id, set()) for image_id in images}
+    return {image_id: keys for image_id, keys in missing.items() if keys}
+
+
+def backfill_image(image_id, keys):
+    """
+    Saves the given derivatives of an image.
+    """
+    data = main.bucket.blob(main.FILENAME_TEMPLATE.format(image_id)).download_as_string()
+    with Image(blob=data) as image:
+        blobs = main.derivatives(image, keys)
+    for (size, format), blob in blobs.items():
+        filename = main.DERIVATIVE_FILENAME_TEMPLATE.format(image_id, size, format)
+        main.upload((filename, (blob, format)))
+
+
+def backfill():
+    """
+    Saves the missing derivatives of all images in the bucket.
+
+    Output:
+       The number of images backfilled.
+    """
+    missing = missing_derivatives(blob.name for blob in main.bucket.list_blobs())
+
+    def run(item):
+        image_id, keys = item
+        try:
+            backfill_image(image_id, keys)
+            return True
+        except Exception:
+            logger.exception('Failed to backfill image %s', image_id)
+            return False
+
+    with futures.ThreadPoolExecutor(max_workers=BACKFILL_CONCURRENCY) as executor:
+        return sum(executor.map(run, missing.items()))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(f'Backfilled {backfill()} images')
@@ -15,12 +15,26 @@
 
 """
 Cloud Function for processing uploaded images.
+
+Each upload is normalized to a 640x640 PNG, saved as {id}.png, along with
+derivatives for responsive images, saved as {id}_{size}.{format}: one per
+size in IMAGE_SIZES and format in IMAGE_FORMATS supported by ImageMagick,
+plus a PNG of each size for browsers without support for these formats.
+
+Images are stored by the SHA-256 digest of the uploaded file, so the same
+photo uploaded again gets the same ID, and is neither converted nor
+uploaded again. {id}.png is saved last: once it exists, so do the
+derivatives. See backfill.py for saving the derivatives of images uploaded
+before they were introduced.
 """
 
 
+from concurrent import futures
+import hashlib
+import logging
 import os
-import uuid
 
+from google.api_core import exceptions
 from google.cloud import storage
 from wand.image import Image
 
@@ -28,8 +42,109 @@ client = storage.Client()
 
 BUCKET = os.environ.get('GCS_BUCKET')
 FILENAME_TEMPLATE = '{}.png'
+DERIVATIVE_FILENAME_TEMPLATE = '{}_{}.{}'
 EXPECTED_WIDTH = 640
 EXPECTED_HEIGHT = 640
+# The widths of the derivatives, in pixels, and their formats besides PNG,
+# in order of preference. Formats ImageMagick cannot encode are skipped.
+IMAGE_SIZES = [int(size) for size in os.environ.get('IMAGE_SIZES', '160,320,640').split(',')]
+IMAGE_FORMATS = os.environ.get('IMAGE_FORMATS', 'avif,webp').split(',')
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 80))
+# The input size of the AutoML model, in pixels. If set, a PNG derivative of
+# this size is also saved for Cloud Function automl.
+AUTOML_INPUT_SIZE = os.environ.get('AUTOML_INPUT_SIZE')
+# Derivatives are never overwritten under the same name.
+CACHE_CONTROL = 'public, max-age=31536000'
+CONTENT_TYPES = {
+    'avif': 'image/avif',
+    'png': 'image/png',
+    'webp': 'image/webp'
+}
+
+# Unlike get_bucket, bucket does not make an API request.
+bucket = client.bucket(BUCKET)
+
+
+def _can_encode(format):
+    """
+    Checks whether ImageMagick is built with a delegate for a format.
+    """
+    try:
+        with Image(width=1, height=1) as image:
+            image.make_blob(format=format)
+        return True
+    except Exception:
+        return False
+
+
+SUPPORTED_FORMATS = [format for format in IMAGE_FORMATS if _can_encode(format)]
+for format in IMAGE_FORMATS:
+    if format not in SUPPORTED_FORMATS:
+        # The app falls back to the PNG derivatives, but IMAGE_FORMATS of the
+        # app should not list it.
+        logging.warning('ImageMagick cannot encode %s; its derivatives are not saved', format)
+
+
+def derivative_keys():
+    """
+    Returns the sizes and formats of the derivatives of an image, as a set
+    of (size, format) tuples.
+    """
+    keys = {(size, format) for size in IMAGE_SIZES for format in ['png'] + SUPPORTED_FORMATS}
+    if AUTOML_INPUT_SIZE:
+        keys.add((int(AUTOML_INPUT_SIZE), 'png'))
+    return keys
+
+
+def derivatives(image, keys=None):
+    """
+    Encodes the derivatives of a normalized image.
+
+    Parameters:
+       image (Image): The 640x640 image.
+       keys (Set[Tuple[int, str]]): The sizes and formats of the derivatives
+                                    to encode. Defaults to derivative_keys().
+
+    Output:
+       A dict of blobs, keyed by (size, format).
+    """
+    if keys is None:
+        keys = derivative_keys()
+
+    blobs = {}
+    for size in sorted({size for size, _ in keys}):
+        with image.clone() as resized:
+            if size != resized.width:
+                resized.resize(size, size)
+            if (size, 'png') in keys:
+                blobs[(size, 'png')] = resized.make_blob(format='png')
+            # Set after encoding the PNG, for which it is the zlib level instead.
+            resized.compression_quality = IMAGE_QUALITY
+            for format in SUPPORTED_FORMATS:
+                if (size, format) in keys:
+                    blobs[(size, format)] = resized.make_blob(format=format)
+    return blobs
+
+
+def upload(item):
+    """
+    Uploads an image, unless an image of the same name already exists.
+
+    Parameters:
+       item (Tuple[str, Tuple[bytes, str]]): The filename of the image, and
+                                             its data and format.
+    """
+    filename, (data, format) = item
+    blob = bucket.blob(filename)
+    blob.cache_control = CACHE_CONTROL
+    try:
+        # Names are content-addressed: if a concurrent upload of the same
+        # file saved the image first, the stored image is identical.
+        blob.upload_from_string(data, content_type=CONTENT_TYPES[format],
+                                if_generation_match=0)
+    except exceptions.PreconditionFailed:
+        pass
+
 
 def upload_image(request):
     # Set up CORS to allow requests from arbitrary origins.
@@ -56,6 +171,10 @@ def upload_image(request):
 
     data = file.read()
 
+    id = hashlib.sha256(data).hexdigest()
+    if bucket.blob(FILENAME_TEMPLATE.format(id)).exists():
+        return (id, 200, headers)
+
     with Image(blob=data) as image:
         image.transform(resize="{}x{}>".format(EXPECTED_WIDTH, EXPECTED_HEIGHT))
         image.extent(
@@ -65,13 +184,16 @@ def upload_image(request):
             y=-int((EXPECTED_HEIGHT - image.height) / 2)            
         )
         converted_image = image.make_blob(format='png')
-    
-    id = uuid.uuid4().hex
-    filename = FILENAME_TEMPLATE.format(id)
+        derivative_images = derivatives(image)
 
-    bucket = client.get_bucket(BUCKET)
-    blob = bucket.blob(filename)
+    uploads = {}
+    for (size, format), derivative_image in derivative_images.items():
+        filename = DERIVATIVE_FILENAME_TEMPLATE.format(id, size, format)
+        uploads[filename] = (derivative_image, format)
 
-    blob.upload_from_string(converted_image, content_type='image/png')
+    # The uploads are I/O bound; run them concurrently.
+    with futures.ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+        list(executor.map(upload, uploads.items()))
+    upload((FILENAME_TEMPLATE.format(id), (converted_image, 'png')))
 
     return (id, 200, headers)